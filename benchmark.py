@@ -0,0 +1,85 @@
+"""Замер скорости разбора страниц: в одном потоке, в пуле потоков и в пуле процессов.
+
+    python benchmark.py [страница.html] [--pages 200] [--backend lxml]
+
+Без файла разбирается сгенерированная страница tap.az с 60 объявлениями.
+Итоги выводятся в stderr, журнал разбора можно скрыть: python benchmark.py > /dev/null
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from parser import extract_listings, set_parse_processes
+from html_backends import set_backend
+
+class SavedResponse:
+    """Ответ с уже загруженной страницей (вместо requests.Response)"""
+
+    def __init__(self, content: bytes):
+        self.content = content
+        self.headers = {'Content-Type': 'text/html; charset=utf-8'}
+
+def sample_page(items: int = 60) -> bytes:
+    """Страница tap.az с items объявлениями и типичной шапкой/подвалом"""
+    blocks = []
+    for i in range(items):
+        blocks.append(
+            f'<div class="products-i">'
+            f'<a class="products-link" href="/elanlar/dasinmaz-emlak/menziller/{40000000 + i}">'
+            f'<div class="products-top"><img src="//tap.azstatic.com/uploads/{i}.jpg"></div>'
+            f'<div class="products-price">{300 + i * 10} AZN</div>'
+            f'<div class="products-name">{i + 1}-otaqlı mənzil, {40 + i} m²</div>'
+            f'<div class="products-location">Bakı, Nəsimi r.</div>'
+            f'<div class="products-created">Bakı, bugün, 12:{i % 60:02d}</div>'
+            f'</a></div>'
+        )
+    padding = '<div class="nav">' + '<a href="/x">ссылка</a>' * 300 + '</div>'
+    script = '<script>' + 'var x = 1;' * 2000 + '</script>'
+    html = f'<html><head>{script}</head><body>{padding}<div class="products">{"".join(blocks)}</div>{padding}</body></html>'
+    return html.encode('utf-8')
+
+def run(response: SavedResponse, pages: int, threads: int = 1) -> float:
+    """Разбирает страницу pages раз; возвращает страниц в секунду"""
+    started = time.perf_counter()
+    if threads == 1:
+        for _ in range(pages):
+            extract_listings('tap_az', response)
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(lambda _: extract_listings('tap_az', response), range(pages)))
+    return pages / (time.perf_counter() - started)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Скорость разбора страниц')
+    parser.add_argument('page', nargs='?', help='сохраненная страница tap.az')
+    parser.add_argument('--pages', type=int, default=200, help='сколько раз разобрать страницу')
+    parser.add_argument('--backend', default='lxml', help='парсер HTML (как HTML_PARSER у бота)')
+    args = parser.parse_args()
+
+    set_backend(args.backend)
+    if args.page:
+        with open(args.page, 'rb') as f:
+            response = SavedResponse(f.read())
+    else:
+        response = SavedResponse(sample_page())
+
+    cores = os.cpu_count() or 1
+    results = [('1 поток', run(response, args.pages))]
+    results.append((f'{cores} потоков', run(response, args.pages, threads=cores)))
+    processes = 1
+    while processes <= cores:
+        if not set_parse_processes(processes):
+            break
+        # Потоки только ставят задачи; разбор идет в процессах
+        results.append((f'{processes} процессов', run(response, args.pages, threads=processes * 2)))
+        processes *= 2
+    set_parse_processes(0)
+
+    print(f"\nПарсер: {args.backend}, страниц: {args.pages}, ядер: {cores}", file=sys.stderr)
+    baseline = results[0][1]
+    for name, rate in results:
+        print(f"{name:>14}: {rate:8.1f} стр./сек  (x{rate / baseline:.2f})", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,27 @@
 import os
+import atexit
+import threading
 import logging
 from telegram import Update, InputMediaPhoto, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Updater, CommandHandler, CallbackContext, CallbackQueryHandler, MessageHandler, Filters
+from telegram.error import BadRequest, RetryAfter
 from dotenv import load_dotenv
-from parser import parse_website
+from parser import parse_website, crawl_website, set_parse_processes, canonical_url, seen_keys
+from fetcher import engine as fetch_engine
+from subscriptions import SubscriptionRegistry, SITE_NAMES
+from page_cache import PageCache
+from html_backends import set_backend, set_partial
+from storage import UserStore, WriteBehind, DB_FILE
+from history import SentHistory
+from photos import PhotoRegistry, PhotoCache
+from details import DetailCache
+from matching import MatcherCache, LimitsMatrix, LIMIT_FIELDS, parse_range
+from outbox import Outbox, INTERACTIVE, AUTO
+from workers import WorkerPool, PoolFull
 from datetime import datetime
 import pytz
-import json
-import requests
 from io import BytesIO
+from functools import partial
 
 # Load environment variables
 load_dotenv()
@@ -28,6 +41,11 @@ TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 if not TOKEN:
     raise ValueError("Не найден токен бота! Проверьте файл .env")
 
+# Разбор страниц в пуле процессов (0 - в потоках проверки). Процессы создаются
+# здесь, до запуска остальных потоков бота
+PARSE_PROCESSES = int(os.getenv('PARSE_PROCESSES', '0'))
+set_parse_processes(PARSE_PROCESSES)
+
 # Файл для хранения URL
 URLS_FILE = 'urls.json'
 
@@ -40,141 +58,146 @@ DEFAULT_URLS = {
     'bina_az': "https://bina.az/baki/kiraye/menziller"
 }
 
+# Названия полей /limits в сообщениях и варианты, которые можно писать в команде
+LIMIT_NAMES = {
+    'price': 'Цена',
+    'rooms': 'Комнаты',
+    'area': 'Площадь'
+}
+LIMIT_ALIASES = {
+    'price': 'price', 'цена': 'price',
+    'rooms': 'rooms', 'комнаты': 'rooms',
+    'area': 'area', 'площадь': 'area'
+}
+
+# Планировщик проверок: сколько поисков проверяется одновременно, сколько может ждать
+# в очереди пула и как долго (в секундах) он может спать, не проверяя новые подписки
+MAX_CONCURRENT_CHECKS = int(os.getenv('MAX_CONCURRENT_CHECKS', '8'))
+CHECK_QUEUE_SIZE = int(os.getenv('CHECK_QUEUE_SIZE', '32'))
+SCHEDULER_MAX_SLEEP = 5
+# Сколько страниц поиска просматривать, если новых объявлений больше одной страницы
+MAX_PAGES = int(os.getenv('MAX_PAGES', '3'))
+# Загрузка и разбор страниц автопроверки идут в отдельном пуле, а не в потоке JobQueue
+check_pool = WorkerPool(MAX_CONCURRENT_CHECKS, CHECK_QUEUE_SIZE, name='check')
+
 # Глобальные переменные для хранения данных пользователей
 user_data = {}
+# Собранные фильтры пользователей (пересобираются после изменения фильтров)
+filter_matchers = MatcherCache()
+
+# Хранилище пользователей (SQLite); при первом запуске переносим users.json
+store = UserStore(os.getenv('USERS_DB', DB_FILE))
+store.migrate_from_json()
+
+# Режим сохранения: batched - пачками раз в FLUSH_INTERVAL сек или при FLUSH_THRESHOLD
+# измененных пользователей (после сбоя возможны повторы за последние секунды), sync - сразу
+PERSIST_MODE = os.getenv('PERSIST_MODE', 'batched')
+FLUSH_INTERVAL = float(os.getenv('FLUSH_INTERVAL', '5'))
+FLUSH_THRESHOLD = int(os.getenv('FLUSH_THRESHOLD', '50'))
+persistence = WriteBehind(store, lambda user_id: user_data[user_id], PERSIST_MODE, FLUSH_INTERVAL, FLUSH_THRESHOLD)
+persistence.start()
+atexit.register(persistence.close)
+
+# file_id загруженных в Telegram фото: повторные отправки не скачивают и не загружают фото
+PHOTO_IDS_CAPACITY = int(os.getenv('PHOTO_IDS_CAPACITY', '10000'))
+photo_registry = PhotoRegistry(store.path, capacity=PHOTO_IDS_CAPACITY)
+
+# Кэш фото на диске (уменьшенных под Telegram): папка, лимит размера и число потоков обработки
+PHOTO_CACHE_DIR = os.getenv('PHOTO_CACHE_DIR', 'photo_cache')
+PHOTO_CACHE_MB = int(os.getenv('PHOTO_CACHE_MB', '200'))
+PHOTO_WORKERS = int(os.getenv('PHOTO_WORKERS', '2'))
+photo_cache = PhotoCache(PHOTO_CACHE_DIR, PHOTO_CACHE_MB * 1024 * 1024, PHOTO_WORKERS, store.path)
+
+# Бюджет запросов к одному сайту: запросов в секунду и одновременных запросов
+# (после 429/503 сайт получает паузу и скорость снижается)
+HOST_RATE = float(os.getenv('HOST_RATE', '2'))
+HOST_CONCURRENCY = int(os.getenv('HOST_CONCURRENCY', '4'))
+fetch_engine.set_host_limits(HOST_RATE, max(1, int(HOST_RATE * 2)), HOST_CONCURRENCY)
+
+# Площадь, комнаты, этаж и фото со страницы объявления: загружаются для прошедших фильтры
+# объявлений, не больше DETAILS_CONCURRENCY одновременно, и сохраняются в базе по id объявления
+ENRICH_DETAILS = os.getenv('ENRICH_DETAILS', '0') != '0'
+DETAILS_CONCURRENCY = int(os.getenv('DETAILS_CONCURRENCY', '4'))
+detail_cache = DetailCache(store.path, DETAILS_CONCURRENCY) if ENRICH_DETAILS else None
+
+# Общие подписки на поиски (одинаковые URL загружаются один раз за цикл);
+# расписание проверок переживает перезапуск
+subscriptions = SubscriptionRegistry(store.load_schedule())
+
+# Кэш результатов парсинга для /t, /b и /parse: время жизни (сек) и максимум страниц
+PAGE_CACHE_TTL = int(os.getenv('PAGE_CACHE_TTL', '60'))
+PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', '256'))
+page_cache = PageCache(ttl=PAGE_CACHE_TTL, max_entries=PAGE_CACHE_SIZE)
+
+# Парсер HTML: lxml (по умолчанию), selectolax или html.parser
+HTML_PARSER = set_backend(os.getenv('HTML_PARSER', 'lxml'))
+
+# Разбирать только контейнеры объявлений, а не всю страницу
+PARTIAL_PARSE = os.getenv('PARTIAL_PARSE', '1') != '0'
+set_partial(PARTIAL_PARSE)
+
+# Доставка: album - новые объявления с фото приходят альбомами до ALBUM_SIZE штук
+# (меньше запросов к Telegram), single - каждое объявление отдельным сообщением
+DELIVERY_MODE = os.getenv('DELIVERY_MODE', 'album')
+ALBUM_SIZE = min(int(os.getenv('ALBUM_SIZE', '10')), 10)
+
+# Все сообщения уходят через общую очередь с лимитами Telegram; OUTBOX_WORKERS - потоков отправки
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '4'))
+outbox = Outbox(OUTBOX_WORKERS)
+# Объявления, стоящие в очереди на отправку: (user_id, ссылка)
+pending_ads = set()
+pending_lock = threading.Lock()
+
+def reply(message, text: str, **kwargs) -> None:
+    """Ответ пользователю через очередь отправки (раньше рассылки автопроверки)"""
+    outbox.submit(message.chat_id, partial(message.reply_text, text, **kwargs), INTERACTIVE)
 
-def trim_sent_ads(user_id: int) -> None:
-    """Ограничивает размер списка отправленных объявлений"""
-    user_data_dict = user_data[user_id]
-    if 'sent_ads' in user_data_dict and len(user_data_dict['sent_ads']) > 100:
-        print(f"Очистка истории для пользователя {user_id}: удаляем {len(user_data_dict['sent_ads']) - 80} старых записей")
-        # Оставляем только последние 2 записи
-        user_data_dict['sent_ads'] = user_data_dict['sent_ads'][-80:]
-        print(f"После очистки: {len(user_data_dict['sent_ads'])} записей")
+def edit(message, text: str, **kwargs) -> None:
+    """Изменение сообщения (меню) через очередь отправки"""
+    outbox.submit(message.chat_id, partial(message.edit_text, text, **kwargs), INTERACTIVE)
+
+def default_user_data() -> dict:
+    """Данные нового пользователя"""
+    return {
+        'urls': DEFAULT_URLS.copy(),
+        'filters': {
+            'title': [],
+            'location': []
+        },
+        'sent_ads': SentHistory(),
+        'auto_check': {
+            'enabled': False,
+            'interval': 300  # значение по умолчанию - 5 минут
+        }
+    }
 
 def get_user_data(user_id: int) -> dict:
-    """Get user data from file"""
+    """Get user data from the database"""
     if user_id not in user_data:
         try:
-            # Пробуем загрузить существующие данные из файла
-            if os.path.exists('users.json'):
-                with open('users.json', 'r', encoding='utf-8') as f:
-                    all_users = json.load(f)
-                    if str(user_id) in all_users:
-                        user_data[user_id] = all_users[str(user_id)]
-                        print(f"Загружены данные пользователя {user_id}")
-                        # Проверяем размер истории и обрезаем при необходимости
-                        if 'sent_ads' in user_data[user_id] and len(user_data[user_id]['sent_ads']) > 10:
-                            trim_sent_ads(user_id)
-                            save_user_data(user_id)
-                    else:
-                        # Если пользователя нет, создаем новую структуру данных
-                        user_data[user_id] = {
-                            'urls': DEFAULT_URLS.copy(),
-                            'filters': {
-                                'title': [],
-                                'location': []
-                            },
-                            'sent_ads': [],
-                            'auto_check': {
-                                'enabled': False,
-                                'interval': 300  # значение по умолчанию - 5 минут
-                            }
-                        }
-                        print(f"Создана новая структура данных для пользователя {user_id}")
+            data = store.load_user(user_id)
+            if data is not None:
+                user_data[user_id] = data
+                print(f"Загружены данные пользователя {user_id}")
             else:
-                # Если файла нет, создаем новую структуру данных
-                user_data[user_id] = {
-                    'urls': DEFAULT_URLS.copy(),
-                    'filters': {
-                        'title': [],
-                        'location': []
-                    },
-                    'sent_ads': [],
-                    'auto_check': {
-                        'enabled': False,
-                        'interval': 300  # значение по умолчанию - 5 минут
-                    }
-                }
+                # Если пользователя нет, создаем новую структуру данных
+                user_data[user_id] = default_user_data()
                 print(f"Создана новая структура данных для пользователя {user_id}")
         except Exception as e:
             print(f"Ошибка при загрузке данных пользователя {user_id}: {str(e)}")
-            user_data[user_id] = {
-                'urls': DEFAULT_URLS.copy(),
-                'filters': {
-                    'title': [],
-                    'location': []
-                },
-                'sent_ads': [],
-                'auto_check': {
-                    'enabled': False,
-                    'interval': 300  # значение по умолчанию - 5 минут
-                }
-            }
+            user_data[user_id] = default_user_data()
     return user_data[user_id]
 
 def save_user_data(user_id: int):
-    """Save user data to file"""
+    """Save user data to the database"""
     try:
-        print(f"== НАЧАЛО СОХРАНЕНИЯ ДАННЫХ для пользователя {user_id} ==")
         # Проверим, что данные пользователя существуют в user_data
         if user_id not in user_data:
             print(f"ERROR: user_id {user_id} отсутствует в user_data!")
             return
             
-        # Проверка ключей в user_data[user_id]
-        if 'sent_ads' not in user_data[user_id]:
-            print(f"ERROR: 'sent_ads' отсутствует в user_data[{user_id}]!")
-            return
-            
-        # Информация о sent_ads перед сохранением
-        sent_ads = user_data[user_id]['sent_ads']
-        print(f"Сохраняем sent_ads, количество: {len(sent_ads)}")
-        if sent_ads:
-            print(f"Первые 3 записи: {sent_ads[:3]}")
-        
-        # Загружаем все существующие данные
-        all_users = {}
-        if os.path.exists('users.json'):
-            with open('users.json', 'r', encoding='utf-8') as f:
-                all_users = json.load(f)
-                print(f"Загружен users.json, пользователей: {len(all_users)}")
-        else:
-            print("Файл users.json не найден, будет создан новый файл")
-        
-        # Обновляем данные текущего пользователя
-        all_users[str(user_id)] = user_data[user_id]
-        
-        # Проверка, присутствуют ли данные в all_users
-        if str(user_id) in all_users:
-            if 'sent_ads' in all_users[str(user_id)]:
-                print(f"Проверка: {len(all_users[str(user_id)]['sent_ads'])} записей в all_users")
-            else:
-                print("ERROR: 'sent_ads' отсутствует в all_users после обновления!")
-        else:
-            print(f"ERROR: {user_id} отсутствует в all_users после обновления!")
-        
-        # Сохраняем все данные
-        with open('users.json', 'w', encoding='utf-8') as f:
-            json.dump(all_users, f, ensure_ascii=False, indent=2)
-            print(f"Данные записаны в users.json")
-        
-        # Проверяем, что данные действительно сохранились
-        if os.path.exists('users.json'):
-            with open('users.json', 'r', encoding='utf-8') as f:
-                check_data = json.load(f)
-                if str(user_id) in check_data:
-                    if 'sent_ads' in check_data[str(user_id)]:
-                        saved_count = len(check_data[str(user_id)]['sent_ads'])
-                        print(f"Проверка после сохранения: {saved_count} записей")
-                        if saved_count != len(sent_ads):
-                            print(f"ВНИМАНИЕ: Количество записей до ({len(sent_ads)}) и после ({saved_count}) сохранения различается!")
-                    else:
-                        print("ERROR: 'sent_ads' отсутствует в данных после сохранения!")
-                else:
-                    print(f"ERROR: {user_id} отсутствует в данных после сохранения!")
-        
-        print(f"== ЗАВЕРШЕНО СОХРАНЕНИЕ ДАННЫХ для пользователя {user_id} ==")
+        # Запись отложенная: изменения сохраняются пачкой (см. PERSIST_MODE)
+        persistence.mark_dirty(user_id)
     except Exception as e:
         print(f"КРИТИЧЕСКАЯ ОШИБКА при сохранении данных пользователя {user_id}: {str(e)}")
         import traceback
@@ -221,7 +244,7 @@ def start(update: Update, context: CallbackContext) -> None:
         '❓ Для получения дополнительной информации используйте /help'
     )
     
-    update.message.reply_text(welcome_message, parse_mode='Markdown', reply_markup=reply_markup, disable_web_page_preview=True)
+    reply(update.message, welcome_message, parse_mode='Markdown', reply_markup=reply_markup, disable_web_page_preview=True)
 
 def help_command(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /help is issued."""
@@ -245,14 +268,15 @@ def help_command(update: Update, context: CallbackContext) -> None:
         '/stop - остановка автоматической проверки\n\n'
         
         '*📋 Управление фильтрами:*\n'
-        '/filter - управление фильтрами для блокировки нежелательных объявлений\n\n'
+        '/filter - управление фильтрами для блокировки нежелательных объявлений\n'
+        '/limits - диапазоны цены, комнат и площади (например, /limits price 300-800)\n\n'
         
         '*📝 Текущие URL:*\n'
         f'tap.az:\n{get_user_data(update.effective_user.id)["urls"]["tap_az"]}\n\n'
         f'bina.az:\n{get_user_data(update.effective_user.id)["urls"]["bina_az"]}'
     )
     
-    update.message.reply_text(help_message, parse_mode='Markdown', disable_web_page_preview=True)
+    reply(update.message, help_message, parse_mode='Markdown', disable_web_page_preview=True)
 
 def change_tap_url(update: Update, context: CallbackContext) -> None:
     """Change tap.az URL for searches."""
@@ -260,18 +284,21 @@ def change_tap_url(update: Update, context: CallbackContext) -> None:
     user_data = get_user_data(user_id)
     
     if not context.args:
-        update.message.reply_text('Пожалуйста, укажите новый URL для tap.az.\n'
-                                'Текущий URL:\n' + user_data['urls']['tap_az'])
+        reply(update.message, 'Пожалуйста, укажите новый URL для tap.az.\n'
+                              'Текущий URL:\n' + user_data['urls']['tap_az'])
         return
         
     new_url = context.args[0]
     if 'tap.az' not in new_url:
-        update.message.reply_text('URL должен быть с сайта tap.az!')
+        reply(update.message, 'URL должен быть с сайта tap.az!')
         return
         
     user_data['urls']['tap_az'] = new_url
     save_user_data(user_id)
-    update.message.reply_text('URL для tap.az успешно обновлен и сохранен!')
+    
+    # Если включена автопроверка, переподписываем пользователя на новый поиск
+    subscribe_user(user_id)
+    reply(update.message, 'URL для tap.az успешно обновлен и сохранен!')
 
 def change_bina_url(update: Update, context: CallbackContext) -> None:
     """Change bina.az URL for searches."""
@@ -279,23 +306,26 @@ def change_bina_url(update: Update, context: CallbackContext) -> None:
     user_data = get_user_data(user_id)
     
     if not context.args:
-        update.message.reply_text('Пожалуйста, укажите новый URL для bina.az.\n'
-                                'Текущий URL:\n' + user_data['urls']['bina_az'])
+        reply(update.message, 'Пожалуйста, укажите новый URL для bina.az.\n'
+                              'Текущий URL:\n' + user_data['urls']['bina_az'])
         return
         
     new_url = context.args[0]
     if 'bina.az' not in new_url:
-        update.message.reply_text('URL должен быть с сайта bina.az!')
+        reply(update.message, 'URL должен быть с сайта bina.az!')
         return
         
     user_data['urls']['bina_az'] = new_url
     save_user_data(user_id)
-    update.message.reply_text('URL для bina.az успешно обновлен и сохранен!')
+    
+    # Если включена автопроверка, переподписываем пользователя на новый поиск
+    subscribe_user(user_id)
+    reply(update.message, 'URL для bina.az успешно обновлен и сохранен!')
 
 def parse_command(update: Update, context: CallbackContext) -> None:
     """Parse website and send results."""
     if not context.args:
-        update.message.reply_text('Пожалуйста, укажите URL сайта для парсинга.')
+        reply(update.message, 'Пожалуйста, укажите URL сайта для парсинга.')
         return
         
     user_id = update.effective_user.id
@@ -328,10 +358,10 @@ def auto_check(update: Update, context: CallbackContext) -> None:
         try:
             interval = int(context.args[0])
             if interval < 60:
-                update.message.reply_text('Минимальный интервал - 60 секунд!')
+                reply(update.message, 'Минимальный интервал - 60 секунд!')
                 interval = 60
         except ValueError:
-            update.message.reply_text('Неверный формат времени! Используется значение по умолчанию (5 минут).')
+            reply(update.message, 'Неверный формат времени! Используется значение по умолчанию (5 минут).')
     
     # Сохраняем информацию о включенной автопроверке
     user_data['auto_check'] = {
@@ -341,266 +371,420 @@ def auto_check(update: Update, context: CallbackContext) -> None:
     }
     save_user_data(user_id)
     
-    # Добавляем задачи
-    context.job_queue.run_repeating(
-        auto_check_callback,
-        interval=interval,
-        first=10,
-        context={'user_id': user_id},
-        name=f'tap_az_check_{user_id}'
-    )
-    
-    context.job_queue.run_repeating(
-        auto_check_bina_callback,
-        interval=interval,
-        first=20,
-        context={'user_id': user_id},
-        name=f'bina_az_check_{user_id}'
-    )
+    # Подписываем пользователя на общие поиски
+    subscribe_user(user_id)
     
-    update.message.reply_text(f'Автоматическая проверка включена (интервал: {interval} секунд)!')
+    reply(update.message, f'Автоматическая проверка включена (интервал: {interval} секунд)!')
 
-def auto_check_callback(context: CallbackContext) -> None:
-    """Callback for automatic checking tap.az."""
-    user_id = context.job.context['user_id']
-    user_data = get_user_data(user_id)
+def user_matcher(user_id: int):
+    """Собранные фильтры пользователя"""
+    return filter_matchers.get(user_id, get_user_data(user_id)['filters'])
+
+def get_chat_id(user_data: dict):
+    """Чат, в который отправляются результаты автопроверки"""
+    return user_data.get('active_chat_id') or user_data.get('auto_check', {}).get('active_chat_id')
+
+def send_listing_photo(send_photo, listing):
+    """Отправляет фото объявления. Уже загруженное в Telegram фото отправляется по file_id -
+    без повторного скачивания и загрузки; send_photo - bot.send_photo или reply_photo с нужным чатом"""
+    file_id = photo_registry.get(listing.photo_url)
+    if file_id:
+        try:
+            return send_photo(photo=file_id, caption=listing.render(), parse_mode='HTML')
+        except BadRequest as e:
+            print(f"file_id фото больше не действителен, загружаем заново: {str(e)}")
+            photo_registry.forget(listing.photo_url)
+            
+    # Фото уже скачано и уменьшено до постановки в очередь (prefetch_photos)
+    data = photo_cache.load(listing.photo_url)
+    if data is None:
+        raise ValueError('фото не загружено')
+    photo = BytesIO(data)
+    photo.name = 'image.jpg'
     
-    if not user_data['active_chat_id']:
-        print(f"ACTIVE_CHAT_ID не установлен для пользователя {user_id}")
+    message = send_photo(
+        photo=photo,
+        caption=listing.render(),
+        parse_mode='HTML',
+        filename='image.jpg'
+    )
+    if message and message.photo:
+        photo_registry.put(listing.photo_url, message.photo[-1].file_id)
+    return message
+
+def claim_new(user_id: int, listings: list, label: str = '') -> list:
+    """Отбирает объявления, которые пользователь еще не получал и которые не стоят в очереди,
+    и отмечает их как ожидающие отправки"""
+    sent_ads = get_user_data(user_id)['sent_ads']
+    new_listings = []
+    with pending_lock:
+        for listing in listings:
+            if listing.link and (listing.link in sent_ads or (user_id, listing.link) in pending_ads):
+                print(f"Пропускаем уже отправленное объявление{label}: {listing.link}")
+                continue
+            if listing.link:
+                pending_ads.add((user_id, listing.link))
+            new_listings.append(listing)
+    return new_listings
+
+def release(user_id: int, listing) -> None:
+    with pending_lock:
+        pending_ads.discard((user_id, listing.link))
+
+def release_claims(user_id: int, listings: list) -> None:
+    """Снимает отметки ожидания с объявлений, которые не будут отправлены: иначе claim_new
+    пропускал бы их до перезапуска"""
+    with pending_lock:
+        for listing in listings:
+            pending_ads.discard((user_id, listing.link))
+
+def mark_sent(user_id: int, listing) -> None:
+    """Добавляет отправленное объявление в историю пользователя"""
+    release(user_id, listing)
+    if not listing.link:
         return
+    sent_ads = get_user_data(user_id)['sent_ads']
+    if sent_ads.add(listing.link):
+        save_user_data(user_id)
+        print(f"Добавлено в историю {SITE_NAMES[listing.site]}: {listing.link}. Всего объявлений: {len(sent_ads)}")
+
+def send_single(bot, chat_id, listing) -> None:
+    """Отправляет одно объявление: фото с подписью, при ошибке фото - текстом"""
+    if listing.photo_url:
+        try:
+            send_listing_photo(partial(bot.send_photo, chat_id=chat_id), listing)
+            return
+        except RetryAfter:
+            # Лимит Telegram - очередь повторит отправку позже
+            raise
+        except Exception as photo_error:
+            print(f"Ошибка при отправке фото {SITE_NAMES[listing.site]}: {str(photo_error)}")
+    bot.send_message(chat_id=chat_id, text=listing.render(), parse_mode='HTML')
+
+def send_album(bot, chat_id, listings: list) -> list:
+    """Отправляет объявления одним альбомом (у каждого фото своя подпись).
+    Возвращает отправленные; объявления, фото которых не удалось получить, в альбом не входят"""
+    media = []
+    included = []
+    for listing in listings:
+        photo = photo_registry.get(listing.photo_url)
+        if not photo:
+            data = photo_cache.load(listing.photo_url)
+            if data is None:
+                print(f"Фото {SITE_NAMES[listing.site]} не загружено: {listing.photo_url}")
+                continue
+            photo = BytesIO(data)
+            photo.name = 'image.jpg'
+        media.append(InputMediaPhoto(media=photo, caption=listing.render(), parse_mode='HTML'))
+        included.append(listing)
         
-    print(f"Запуск проверки tap.az для пользователя {user_id}")
-    
+    # Альбом - минимум из двух фото, одно объявление отправится обычным способом
+    if len(media) < 2:
+        return []
+        
+    messages = bot.send_media_group(chat_id=chat_id, media=media)
+    for listing, message in zip(included, messages):
+        if message.photo:
+            photo_registry.put(listing.photo_url, message.photo[-1].file_id)
+    return included
+
+def queue_single(bot, chat_id, user_id: int, listing, priority: int, on_done=None) -> None:
+    """Ставит одно объявление в очередь отправки. on_done(объявление, отправлено) вызывается,
+    когда судьба объявления решена"""
+    def sent(result):
+        mark_sent(user_id, listing)
+        if on_done:
+            on_done(listing, True)
+            
+    def failed(error):
+        release(user_id, listing)
+        print(f"Ошибка при обработке объявления {SITE_NAMES[listing.site]}: {str(error)}")
+        if on_done:
+            on_done(listing, False)
+        
+    outbox.submit(chat_id, partial(send_single, bot, chat_id, listing), priority,
+                  on_sent=sent, on_error=failed)
+
+def queue_album(bot, chat_id, user_id: int, listings: list, priority: int, on_done=None) -> None:
+    """Ставит альбом в очередь отправки; не вошедшие в него объявления отправятся по одному"""
+    def sent(included):
+        for listing in listings:
+            if listing in included:
+                mark_sent(user_id, listing)
+                if on_done:
+                    on_done(listing, True)
+            else:
+                queue_single(bot, chat_id, user_id, listing, priority, on_done)
+                
+    def failed(error):
+        # Не знаем, какое фото испортило альбом - отправляем эту пачку по одному
+        print(f"Ошибка при отправке альбома, отправляем по одному: {str(error)}")
+        for listing in listings:
+            queue_single(bot, chat_id, user_id, listing, priority, on_done)
+            
+    outbox.submit(chat_id, partial(send_album, bot, chat_id, listings), priority,
+                  cost=len(listings), on_sent=sent, on_error=failed)
+
+def enrich_listings(listings: list) -> None:
+    """Дополняет объявления данными с их страниц (если включено ENRICH_DETAILS)"""
+    if detail_cache is None or not listings:
+        return
     try:
-        results = parse_website(user_data['urls']['tap_az'], user_data['filters'])
-        print(f"Получено {len(results) if results else 0} результатов с tap.az")
-        if results and len(results) > 0:
-            for result in results:
-                try:
-                    # Выводим результат для отладки
-                    print(f"Результат tap.az: {result}")
-                    print(f"Ссылка: {result.get('link', 'НЕТ ССЫЛКИ')}")
-                    print(f"Текущая история: {user_data['sent_ads'][:5] if user_data['sent_ads'] else '[]'}")
-                    
-                    # Проверяем, не было ли это объявление уже отправлено
-                    if result.get('link') and result['link'] in user_data['sent_ads']:
-                        print(f"Пропускаем уже отправленное объявление tap.az: {result['link']}")
-                        continue
-                    
-                    message_sent = False
-                    if result.get('photo_url'):
-                        try:
-                            response = requests.get(result['photo_url'])
-                            photo = BytesIO(response.content)
-                            photo.name = 'image.jpg'
-                            
-                            context.bot.send_photo(
-                                chat_id=user_data['active_chat_id'],
-                                photo=photo,
-                                caption=result['message'],
-                                parse_mode='HTML',
-                                filename='image.jpg'
-                            )
-                            message_sent = True
-                        except Exception as photo_error:
-                            print(f"Ошибка при отправке фото tap.az: {str(photo_error)}")
-                            context.bot.send_message(
-                                chat_id=user_data['active_chat_id'],
-                                text=result['message'],
-                                parse_mode='HTML'
-                            )
-                            message_sent = True
-                    else:
-                        context.bot.send_message(
-                            chat_id=user_data['active_chat_id'],
-                            text=result['message'],
-                            parse_mode='HTML'
-                        )
-                        message_sent = True
-                    
-                    # Если сообщение успешно отправлено и есть ссылка, добавляем в историю
-                    if message_sent and result.get('link'):
-                        print(f"Добавляем в историю tap.az: {result['link']}")
-                        print(f"Был ли в истории: {result['link'] in user_data['sent_ads']}")
-                        
-                        if result['link'] not in user_data['sent_ads']:
-                            user_data['sent_ads'].append(result['link'])
-                            # Проверяем, добавилась ли ссылка
-                            print(f"Проверка добавления: {result['link'] in user_data['sent_ads']}")
-                            
-                            # Проверяем размер истории и обрезаем при необходимости
-                            trim_sent_ads(user_id)
-                            
-                            try:
-                                save_user_data(user_id)
-                                print(f"История tap.az обновлена. Текущее количество объявлений: {len(user_data['sent_ads'])}")
-                            except Exception as save_error:
-                                print(f"ОШИБКА при сохранении истории tap.az: {str(save_error)}")
-                except Exception as e:
-                    print(f"Ошибка при обработке объявления tap.az: {str(e)}")
-                    continue
+        detail_cache.enrich(listings)
     except Exception as e:
-        print(f"Ошибка при автопроверке tap.az: {str(e)}")
-        context.bot.send_message(
-            chat_id=user_data['active_chat_id'],
-            text=f'Произошла ошибка при автоматической проверке Tap.az: {str(e)}'
-        )
+        print(f"Ошибка при загрузке страниц объявлений: {str(e)}")
 
-def auto_check_bina_callback(context: CallbackContext) -> None:
-    """Callback for automatic checking bina.az."""
-    user_id = context.job.context['user_id']
-    user_data = get_user_data(user_id)
+def prefetch_photos(listings: list) -> None:
+    """Скачивает и уменьшает фото объявлений до постановки в очередь: потоки отправки
+    не ждут сеть и обработку фото. Фото, уже загруженные в Telegram, не нужны."""
+    photo_cache.prefetch([
+        listing.photo_url for listing in listings
+        if listing.photo_url and not photo_registry.get(listing.photo_url)
+    ])
+
+def limit_masks(user_ids: list, listings: list) -> dict:
+    """Какие объявления пачки подходят под диапазоны (/limits) каждого пользователя;
+    пользователей без диапазонов в ответе нет"""
+    limits = LimitsMatrix({user_id: get_user_data(user_id).get('limits') for user_id in user_ids})
+    if limits.needs_details:
+        # Комнаты и площадь известны только со страниц объявлений
+        enrich_listings(listings)
+    return limits.mask(listings)
+
+def send_listings(bot, chat_id, user_id: int, listings: list, priority: int = AUTO, on_done=None) -> None:
+    """Ставит объявления в очередь отправки; после отправки они попадают в историю пользователя.
+    В режиме album объявления с фото группируются в альбомы по ALBUM_SIZE.
+    on_done(объявление, отправлено) - для каждого объявления, когда оно отправлено или не удалось"""
+    pending = list(listings)
     
-    if not user_data['active_chat_id']:
-        print(f"ACTIVE_CHAT_ID не установлен для пользователя {user_id}")
+    if DELIVERY_MODE == 'album':
+        with_photo = [listing for listing in pending if listing.photo_url]
+        for start in range(0, len(with_photo), ALBUM_SIZE):
+            chunk = with_photo[start:start + ALBUM_SIZE]
+            if len(chunk) < 2:
+                break
+            queue_album(bot, chat_id, user_id, chunk, priority, on_done)
+            for listing in chunk:
+                pending.remove(listing)
+                
+    for listing in pending:
+        queue_single(bot, chat_id, user_id, listing, priority, on_done)
+
+def schedule_checks(job_queue) -> None:
+    """Планирует следующий запуск проверки подписок на время ближайшего поиска"""
+    delay = subscriptions.next_delay()
+    delay = SCHEDULER_MAX_SLEEP if delay is None else min(delay, SCHEDULER_MAX_SLEEP)
+    job_queue.run_once(subscriptions_callback, delay, name='subscriptions_check')
+
+def save_schedule() -> None:
+    """Сохраняет изменения расписания проверок (только изменившиеся поиски)"""
+    try:
+        store.save_schedule(*subscriptions.changes())
+    except Exception as e:
+        print(f"Ошибка при сохранении расписания проверок: {str(e)}")
+
+def subscriptions_callback(context: CallbackContext) -> None:
+    """Проверяет подошедшие по времени поиски и планирует следующий запуск"""
+    try:
+        check_due_subscriptions(context)
+    finally:
+        schedule_checks(context.job_queue)
+
+def check_due_subscriptions(context: CallbackContext) -> None:
+    """Ставит подошедшие поиски в пул проверок (сколько в нем есть места) и сразу возвращается.
+    Поиски, которым не хватило места, остаются в расписании и уйдут при следующем запуске."""
+    free = check_pool.free_slots()
+    if free <= 0:
+        stats = check_pool.stats()
+        print(f"Пул проверок занят ({stats['running']} выполняется, {stats['queued']} в очереди), "
+              f"ожидают проверки: {subscriptions.overdue()}")
         return
         
-    print(f"Запуск проверки bina.az для пользователя {user_id}")
+    due = subscriptions.due(limit=free)
+    if not due:
+        return
+    save_schedule()
+        
+    # Поиски загружаются без фильтров: у каждого подписчика они свои.
+    # Условные запросы: неизменившиеся страницы не скачиваются и не парсятся,
+    # а разбор останавливается на первом уже виденном объявлении
+    for key, site, subscribers, fresh in due:
+        try:
+            future = check_pool.submit(run_check, key, site, subscribers, fresh)
+        except PoolFull as e:
+            print(f"Проверка {SITE_NAMES[site]} отложена: {str(e)}")
+            continue
+        future.add_done_callback(partial(handle_check_result, context.bot, key, site, subscribers, fresh))
+
+def run_check(key: str, site: str, subscribers: list, fresh: list):
+    """Задача пула проверок: загружает поиск, отбирает новые объявления каждому подписчику,
+    загружает страницы объявлений и фото. Возвращает готовые отправки
+    [(user_id, chat_id, объявления)] и все найденные объявления."""
+    site_name = SITE_NAMES[site]
+    print(f"Проверка {site_name} для {len(subscribers)} подписчиков: {key}")
+    if fresh:
+        # Новым подписчикам нужны текущие объявления, а не только новее виденных:
+        # читаем первые объявления страницы, как /t (история отправленных отсеет повторы у остальных)
+        results = crawl_website(key)
+    else:
+        results = crawl_website(key, conditional=True, seen=subscriptions.seen(key), max_pages=MAX_PAGES)
+    print(f"Получено {len(results)} новых результатов с {site_name}")
+    if not results:
+        return [], []
+        
+    # Фильтры всех подписчиков проверяются за один просмотр каждого объявления
+    index = filter_matchers.index(key, subscribers, lambda user_id: get_user_data(user_id)['filters'])
+    excluded = [index.excluded(listing) for listing in results]
+    # Диапазоны цены, комнат и площади - одной маской на всю пачку
+    masks = limit_masks(subscribers, results)
     
+    deliveries = []
+    for user_id in subscribers:
+        chat_id = get_chat_id(get_user_data(user_id))
+        if not chat_id:
+            print(f"ACTIVE_CHAT_ID не установлен для пользователя {user_id}")
+            continue
+        mask = masks.get(user_id)
+        matched = [
+            listing for i, listing in enumerate(results)
+            if user_id not in excluded[i] and (mask is None or mask[i])
+        ]
+        new_listings = claim_new(user_id, matched, f' {site_name}')
+        if new_listings:
+            deliveries.append((user_id, chat_id, new_listings))
+            
+    # Объявления общие для всех подписчиков: каждое дополняется и каждое фото готовится один раз
+    to_send = list({id(listing): listing for _, _, listings in deliveries for listing in listings}.values())
     try:
-        results = parse_website(user_data['urls']['bina_az'], user_data['filters'])
-        print(f"Получено {len(results) if results else 0} результатов с bina.az")
-        if results and len(results) > 0:
-            for result in results:
-                try:
-                    # Проверяем, не было ли это объявление уже отправлено
-                    if result.get('link') and result['link'] in user_data['sent_ads']:
-                        print(f"Пропускаем уже отправленное объявление bina.az: {result['link']}")
-                        continue
-                    
-                    message_sent = False
-                    if result.get('photo_url'):
-                        try:
-                            response = requests.get(result['photo_url'])
-                            photo = BytesIO(response.content)
-                            photo.name = 'image.jpg'
-                            
-                            context.bot.send_photo(
-                                chat_id=user_data['active_chat_id'],
-                                photo=photo,
-                                caption=result['message'],
-                                parse_mode='HTML',
-                                filename='image.jpg'
-                            )
-                            message_sent = True
-                        except Exception as photo_error:
-                            print(f"Ошибка при отправке фото bina.az: {str(photo_error)}")
-                            context.bot.send_message(
-                                chat_id=user_data['active_chat_id'],
-                                text=result['message'],
-                                parse_mode='HTML'
-                            )
-                            message_sent = True
-                    else:
-                        context.bot.send_message(
-                            chat_id=user_data['active_chat_id'],
-                            text=result['message'],
-                            parse_mode='HTML'
-                        )
-                        message_sent = True
-                    
-                    # Если сообщение успешно отправлено и есть ссылка, добавляем в историю
-                    if message_sent and result.get('link'):
-                        print(f"Добавляем в историю bina.az: {result['link']}")
-                        if result['link'] not in user_data['sent_ads']:
-                            user_data['sent_ads'].append(result['link'])
-                            
-                            # Проверяем размер истории и обрезаем при необходимости
-                            trim_sent_ads(user_id)
-                            
-                            save_user_data(user_id)
-                            print(f"История bina.az обновлена. Текущее количество объявлений: {len(user_data['sent_ads'])}")
-                except Exception as e:
-                    print(f"Ошибка при обработке объявления bina.az: {str(e)}")
-                    continue
-    except Exception as e:
-        print(f"Ошибка при автопроверке bina.az: {str(e)}")
-        context.bot.send_message(
-            chat_id=user_data['active_chat_id'],
-            text=f'Произошла ошибка при автоматической проверке Bina.az: {str(e)}'
-        )
+        enrich_listings(to_send)
+        prefetch_photos(to_send)
+    except Exception:
+        for user_id, _, listings in deliveries:
+            release_claims(user_id, listings)
+        raise
+    return deliveries, results
+
+def seen_tracker(key: str, results: list, deliveries: list):
+    """Запоминает виденные объявления поиска, когда решена судьба всех отправок проверки:
+    неотправленные (ошибка Telegram) остаются ниже отметки и уйдут со следующей проверкой.
+    Возвращает done(user_id, объявление, отправлено)"""
+    outstanding = {(user_id, listing) for user_id, _, listings in deliveries for listing in listings}
+    unsent = set()
+    lock = threading.Lock()
+    
+    def finish():
+        keys = seen_keys(results, unsent)
+        if keys:
+            subscriptions.mark_seen(key, keys)
+            
+    def done(user_id: int, listing, ok: bool) -> None:
+        with lock:
+            if (user_id, listing) not in outstanding:
+                return
+            outstanding.discard((user_id, listing))
+            if not ok:
+                unsent.add(listing)
+            finished = not outstanding
+        if finished:
+            finish()
+            
+    if not outstanding:
+        finish()
+    return done
+
+def handle_check_result(bot, key: str, site: str, subscribers: list, fresh: list, future) -> None:
+    """Ставит готовые отправки проверки в очередь (вызывается по готовности задачи пула;
+    вся загрузка и разбор уже сделаны в run_check, здесь только очередь отправки)"""
+    site_name = SITE_NAMES[site]
+    error = future.exception()
+    if error is not None:
+        print(f"Ошибка при автопроверке {site_name}: {str(error)}")
+        for user_id in subscribers:
+            chat_id = get_chat_id(get_user_data(user_id))
+            if not chat_id:
+                continue
+            outbox.submit(chat_id, partial(
+                bot.send_message,
+                chat_id=chat_id,
+                text=f'Произошла ошибка при автоматической проверке {site_name}: {str(error)}'
+            ))
+        return
+        
+    deliveries, results = future.result()
+    done = seen_tracker(key, results, deliveries)
+    for user_id, chat_id, listings in deliveries:
+        try:
+            send_listings(bot, chat_id, user_id, listings, on_done=partial(done, user_id))
+        except Exception as e:
+            print(f"Ошибка при отправке результатов пользователю {user_id}: {str(e)}")
+            release_claims(user_id, listings)
+            for listing in listings:
+                done(user_id, listing, False)
+                
+    subscriptions.seeded(key, fresh)
+
+def unsubscribe_user(user_id: int) -> None:
+    """Отписывает пользователя от всех поисков и забывает индексы фильтров опустевших поисков"""
+    for key in subscriptions.unsubscribe(user_id):
+        filter_matchers.drop_index(key)
+
+def subscribe_user(user_id: int, fresh: bool = True) -> None:
+    """(Пере)подписывает пользователя на его сохраненные поиски. fresh - первая проверка
+    пришлет ему текущие объявления поиска (а не только новее виденных прошлыми проверками)"""
+    user_data = get_user_data(user_id)
+    unsubscribe_user(user_id)
+    
+    auto_check = user_data.get('auto_check', {})
+    if not auto_check.get('enabled', False):
+        return
+        
+    interval = auto_check.get('interval', 300)
+    for site in ('tap_az', 'bina_az'):
+        subscriptions.subscribe(user_id, site, user_data['urls'][site], interval, fresh)
+
+def cached_parse(url: str) -> list:
+    """Парсит страницу через общий кэш (одновременные запросы одного URL ждут одну загрузку)"""
+    key = canonical_url(url)
+    return page_cache.get_or_load(key, lambda: parse_website(key))
 
 def send_parsing_results(update: Update, context: CallbackContext, url: str) -> None:
     """Send parsing results to the user."""
     user_id = update.effective_user.id
-    user_data_dict = get_user_data(user_id)
     
     try:
-        results = parse_website(url, user_data_dict['filters'])
+        # Одинаковые запросы за последние секунды берутся из общего кэша
+        results = cached_parse(url)
+        matcher = user_matcher(user_id)
+        results = [listing for listing in results if matcher.passes(listing)]
+        mask = limit_masks([user_id], results).get(user_id)
+        if mask is not None:
+            results = [listing for listing, fits in zip(results, mask) if fits]
         if not results:
-            update.message.reply_text('Новых объявлений не найдено!')
+            reply(update.message, 'Новых объявлений не найдено!')
             return
             
-        for result in results:
-            try:
-                # Проверяем, не было ли это объявление уже отправлено
-                if result.get('link') and result['link'] in user_data_dict['sent_ads']:
-                    print(f"Пропускаем уже отправленное объявление: {result['link']}")
-                    continue
-                    
-                message_sent = False
-                if result.get('photo_url'):
-                    try:
-                        response = requests.get(result['photo_url'])
-                        photo = BytesIO(response.content)
-                        photo.name = 'image.jpg'
-                        
-                        update.message.reply_photo(
-                            photo=photo,
-                            caption=result['message'],
-                            parse_mode='HTML',
-                            filename='image.jpg',
-                            quote=False
-                        )
-                        message_sent = True
-                    except Exception as photo_error:
-                        print(f"Ошибка при отправке фото: {str(photo_error)}")
-                        update.message.reply_text(
-                            result['message'],
-                            parse_mode='HTML'
-                        )
-                        message_sent = True
-                else:
-                    update.message.reply_text(
-                        result['message'],
-                        parse_mode='HTML'
-                    )
-                    message_sent = True
-                
-                # Если сообщение успешно отправлено и есть ссылка, добавляем в историю
-                if message_sent and result.get('link'):
-                    print(f"Добавляем в историю: {result['link']}")
-                    if result['link'] not in user_data_dict['sent_ads']:
-                        user_data_dict['sent_ads'].append(result['link'])
-                        
-                        # Проверяем размер истории и обрезаем при необходимости
-                        trim_sent_ads(user_id)
-                        
-                        save_user_data(user_id)
-                        print(f"История обновлена. Текущее количество объявлений: {len(user_data_dict['sent_ads'])}")
-                    
-            except Exception as e:
-                print(f"Ошибка при обработке объявления: {str(e)}")
-                continue
+        # Уже отправленные объявления пропускаем
+        new_listings = claim_new(user_id, results)
+        try:
+            enrich_listings(new_listings)
+            prefetch_photos(new_listings)
+        except Exception:
+            release_claims(user_id, new_listings)
+            raise
+        send_listings(context.bot, update.effective_chat.id, user_id, new_listings, INTERACTIVE)
                 
     except Exception as e:
         error_message = f'Произошла ошибка при парсинге: {str(e)}'
         print(error_message)
-        update.message.reply_text(error_message)
+        reply(update.message, error_message)
 
 def stop_auto_check(update: Update, context: CallbackContext) -> None:
     """Stop automatic checking."""
     user_id = update.effective_user.id
     user_data = get_user_data(user_id)
     
-    # Останавливаем все задачи пользователя
-    current_jobs = context.job_queue.get_jobs_by_name(f'tap_az_check_{user_id}')
-    for job in current_jobs:
-        job.schedule_removal()
-    
-    current_jobs = context.job_queue.get_jobs_by_name(f'bina_az_check_{user_id}')
-    for job in current_jobs:
-        job.schedule_removal()
+    # Отписываем пользователя от всех поисков
+    unsubscribe_user(user_id)
     
     # Сохраняем информацию о выключенной автопроверке
     if 'auto_check' in user_data:
@@ -609,7 +793,63 @@ def stop_auto_check(update: Update, context: CallbackContext) -> None:
     
     # Отправляем сообщение только если это прямой вызов команды
     if update.message:
-        update.message.reply_text('Автоматическая проверка остановлена!')
+        reply(update.message, 'Автоматическая проверка остановлена!')
+
+def format_limits(limits: dict) -> str:
+    """Диапазоны пользователя для сообщения"""
+    lines = []
+    for field in LIMIT_FIELDS:
+        if field not in limits:
+            continue
+        low, high = limits[field]
+        if low == high:
+            text = f'{low:g}'
+        elif high is None:
+            text = f'от {low:g}'
+        elif low is None:
+            text = f'до {high:g}'
+        else:
+            text = f'{low:g} - {high:g}'
+        lines.append(f'{LIMIT_NAMES[field]}: {text}')
+    return '\n'.join(lines) if lines else 'не заданы'
+
+def limits_command(update: Update, context: CallbackContext) -> None:
+    """Диапазоны цены, комнат и площади: /limits price 300-800, /limits rooms 2-, /limits clear"""
+    user_id = update.effective_user.id
+    user_data = get_user_data(user_id)
+    limits = user_data.get('limits', {})
+    
+    if not context.args:
+        reply(update.message,
+              'Текущие диапазоны:\n' + format_limits(limits) + '\n\n'
+              'Установить: /limits price 300-800, /limits rooms 2-3, /limits area 50-\n'
+              'Убрать: /limits price -, все сразу: /limits clear')
+        return
+        
+    field = LIMIT_ALIASES.get(context.args[0].lower())
+    if context.args[0].lower() == 'clear':
+        limits = {}
+    elif field is None:
+        reply(update.message, 'Неизвестное поле. Доступны: price (цена), rooms (комнаты), area (площадь)')
+        return
+    elif len(context.args) < 2:
+        reply(update.message, 'Укажите диапазон, например: /limits price 300-800')
+        return
+    elif ''.join(context.args[1:]).strip() == '-':
+        limits.pop(field, None)
+    else:
+        try:
+            limits[field] = list(parse_range(''.join(context.args[1:])))
+        except ValueError:
+            reply(update.message, 'Неверный диапазон. Примеры: 300-800, 300-, -800, 2')
+            return
+            
+    if limits:
+        user_data['limits'] = limits
+    else:
+        user_data.pop('limits', None)
+    save_user_data(user_id)
+    reply(update.message, 'Диапазоны сохранены:\n' + format_limits(limits))
 
 def filter_command(update: Update, context: CallbackContext) -> None:
     """Show filter management menu with inline buttons."""
@@ -641,10 +881,10 @@ def filter_command(update: Update, context: CallbackContext) -> None:
     
     # Если это ответ на callback query, используем edit_text
     if update.callback_query:
-        update.callback_query.message.edit_text(message, reply_markup=reply_markup)
+        edit(update.callback_query.message, message, reply_markup=reply_markup)
     else:
         # Если это новый вызов команды, используем reply_text
-        update.message.reply_text(message, reply_markup=reply_markup)
+        reply(update.message, message, reply_markup=reply_markup)
 
 def filter_callback(update: Update, context: CallbackContext) -> None:
     """Handle filter button callbacks."""
@@ -661,7 +901,8 @@ def filter_callback(update: Update, context: CallbackContext) -> None:
         # Очищаем все фильтры
         user_data['filters'] = {'title': [], 'location': []}
         save_user_data(user_id)
-        query.message.reply_text('Все фильтры удалены!')
+        filter_matchers.bump(user_id)
+        reply(query.message, 'Все фильтры удалены!')
         filter_command(update, context)  # Показываем обновленное меню
         return
         
@@ -681,7 +922,7 @@ def filter_callback(update: Update, context: CallbackContext) -> None:
             ]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        query.message.edit_text(
+        edit(query.message,
             'Выберите город или "Другое" для ручного ввода:',
             reply_markup=reply_markup
         )
@@ -692,7 +933,7 @@ def filter_callback(update: Update, context: CallbackContext) -> None:
         if city == 'other':
             # Запрашиваем ручной ввод
             context.user_data['filter_action'] = 'add'
-            query.message.reply_text(
+            reply(query.message,
                 'Введите название города или района:\n'
                 '(или отправьте /cancel для отмены)'
             )
@@ -703,14 +944,15 @@ def filter_callback(update: Update, context: CallbackContext) -> None:
             if city not in user_data['filters']['location']:
                 user_data['filters']['location'].append(city)
             save_user_data(user_id)
-            query.message.reply_text(f'Фильтр "{city}" добавлен!')
+            filter_matchers.bump(user_id)
+            reply(query.message, f'Фильтр "{city}" добавлен!')
             filter_command(update, context)
         return
         
     if action == 'remove':
         # Показываем кнопки с текущими фильтрами
         if not user_data['filters']['location']:
-            query.message.reply_text('Нет активных фильтров для удаления!')
+            reply(query.message, 'Нет активных фильтров для удаления!')
             return
             
         # Создаем кнопки для каждого фильтра
@@ -721,7 +963,7 @@ def filter_callback(update: Update, context: CallbackContext) -> None:
         keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data='filter_back')])
         
         reply_markup = InlineKeyboardMarkup(keyboard)
-        query.message.edit_text(
+        edit(query.message,
             'Выберите фильтр для удаления:',
             reply_markup=reply_markup
         )
@@ -735,7 +977,8 @@ def filter_callback(update: Update, context: CallbackContext) -> None:
         if filter_text in user_data['filters']['location']:
             user_data['filters']['location'].remove(filter_text)
         save_user_data(user_id)
-        query.message.reply_text(f'Фильтр "{filter_text}" удален!')
+        filter_matchers.bump(user_id)
+        reply(query.message, f'Фильтр "{filter_text}" удален!')
         filter_command(update, context)  # Показываем обновленное меню
         return
         
@@ -761,7 +1004,8 @@ def handle_filter_text(update: Update, context: CallbackContext) -> None:
         if filter_text not in user_data['filters']['location']:
             user_data['filters']['location'].append(filter_text)
         save_user_data(user_id)
-        update.message.reply_text(f'Фильтр "{filter_text}" добавлен!')
+        filter_matchers.bump(user_id)
+        reply(update.message, f'Фильтр "{filter_text}" добавлен!')
     
     # Очищаем данные
     del context.user_data['filter_action']
@@ -773,7 +1017,7 @@ def cancel_filter(update: Update, context: CallbackContext) -> None:
     """Cancel filter operation."""
     if 'filter_action' in context.user_data:
         del context.user_data['filter_action']
-        update.message.reply_text('Операция отменена.')
+        reply(update.message, 'Операция отменена.')
         filter_command(update, context)
 
 def menu_callback(update: Update, context: CallbackContext) -> None:
@@ -805,54 +1049,39 @@ def restore_auto_checks(dispatcher) -> None:
     print("Восстановление автопроверок...")
     
     try:
-        if os.path.exists('users.json'):
-            with open('users.json', 'r', encoding='utf-8') as f:
-                all_users = json.load(f)
+        for user_id, interval, active_chat_id in store.auto_check_users():
+            try:
+                if active_chat_id:
+                    print(f"Восстановление автопроверки для пользователя {user_id}, интервал: {interval} сек.")
+                    
+                    # Подписываем пользователя на его поиски; проверки продолжают с сохраненных отметок
+                    subscribe_user(user_id, fresh=False)
+                    
+                    # Уведомляем пользователя о восстановлении автопроверки
+                    outbox.submit(active_chat_id, partial(
+                        dispatcher.bot.send_message,
+                        chat_id=active_chat_id,
+                        text=f'Бот был перезапущен. Автоматическая проверка восстановлена (интервал: {interval} секунд)!'
+                    ))
+            except Exception as e:
+                print(f"Ошибка при восстановлении автопроверки для пользователя {user_id}: {str(e)}")
                 
-                for user_id_str, user_data_dict in all_users.items():
-                    try:
-                        user_id = int(user_id_str)
-                        
-                        # Проверяем, есть ли у пользователя включенная автопроверка
-                        if 'auto_check' in user_data_dict and user_data_dict['auto_check'].get('enabled', False):
-                            interval = user_data_dict['auto_check'].get('interval', 300)
-                            active_chat_id = user_data_dict['auto_check'].get('active_chat_id')
-                            
-                            if active_chat_id:
-                                print(f"Восстановление автопроверки для пользователя {user_id}, интервал: {interval} сек.")
-                                
-                                # Добавляем задачи в планировщик
-                                dispatcher.job_queue.run_repeating(
-                                    auto_check_callback,
-                                    interval=interval,
-                                    first=10,
-                                    context={'user_id': user_id},
-                                    name=f'tap_az_check_{user_id}'
-                                )
-                                
-                                dispatcher.job_queue.run_repeating(
-                                    auto_check_bina_callback,
-                                    interval=interval,
-                                    first=20,
-                                    context={'user_id': user_id},
-                                    name=f'bina_az_check_{user_id}'
-                                )
-                                
-                                # Уведомляем пользователя о восстановлении автопроверки
-                                try:
-                                    dispatcher.bot.send_message(
-                                        chat_id=active_chat_id,
-                                        text=f'Бот был перезапущен. Автоматическая проверка восстановлена (интервал: {interval} секунд)!'
-                                    )
-                                except Exception as e:
-                                    print(f"Ошибка при отправке уведомления пользователю {user_id}: {str(e)}")
-                    except Exception as e:
-                        print(f"Ошибка при восстановлении автопроверки для пользователя {user_id_str}: {str(e)}")
-                        
         print("Восстановление автопроверок завершено")
     except Exception as e:
         print(f"Ошибка при восстановлении автопроверок: {str(e)}")
 
+def outbox_stats_callback(context: CallbackContext) -> None:
+    """Периодически выводит состояние очереди отправки"""
+    stats = outbox.stats()
+    if not (stats['interactive'] or stats['auto'] or stats['max_wait']):
+        return
+    print(
+        f"Очередь отправки: ответов {stats['interactive']}, рассылки {stats['auto']} "
+        f"(чатов {stats['chats']}); отправлено {stats['sent']}, ошибок {stats['failed']}, "
+        f"429: {stats['rate_limited']}; ожидание в среднем {stats['avg_wait']:.1f} сек., "
+        f"максимум {stats['max_wait']:.1f} сек."
+    )
+
 def main() -> None:
     """Start the bot."""
     try:
@@ -866,6 +1095,7 @@ def main() -> None:
         commands = [
             ('start', 'Запустить бота'),
             ('filter', 'Управление фильтрами'),
+            ('limits', 'Цена, комнаты, площадь'),
             ('auto', 'Включить автопроверку'),
             ('stop', 'Остановить автопроверку'),
             ('help', 'Показать справку'),
@@ -887,6 +1117,7 @@ def main() -> None:
         dispatcher.add_handler(CommandHandler("auto", auto_check))
         dispatcher.add_handler(CommandHandler("stop", stop_auto_check))
         dispatcher.add_handler(CommandHandler("filter", filter_command))
+        dispatcher.add_handler(CommandHandler("limits", limits_command))
         dispatcher.add_handler(CommandHandler("cancel", cancel_filter))
         
         # Add callback query handlers
@@ -899,11 +1130,27 @@ def main() -> None:
         # Восстанавливаем автопроверки
         restore_auto_checks(dispatcher)
         
+        # Планировщик проверок подписок
+        schedule_checks(dispatcher.job_queue)
+        
+        # Отчет о глубине очереди отправки и времени ожидания
+        dispatcher.job_queue.run_repeating(outbox_stats_callback, interval=60, first=60, name='outbox_stats')
+        
         # Start the Bot
         updater.start_polling()
 
         # Run the bot until the user presses Ctrl-C or the process receives SIGINT, SIGTERM or SIGABRT
         updater.idle()
+        
+        # Дожидаемся отправки очереди, сохраняем несохраненные изменения и закрываем пулы соединений
+        check_pool.close()
+        # Отметки последних проверок, сделанных после прошлого сохранения
+        save_schedule()
+        set_parse_processes(0)
+        outbox.close()
+        persistence.close()
+        photo_cache.close()
+        fetch_engine.close()
     except Exception as e:
         print(f"Критическая ошибка при запуске бота: {str(e)}")
         import traceback
@@ -0,0 +1,144 @@
+import threading
+import time
+from typing import Dict, List
+from storage import DB_FILE, SqliteBacked
+from fetcher import engine as fetch_engine
+from html_backends import parse_html, page_encoding
+from history import ad_key
+from listing import Listing, parse_price
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ad_details (
+    ad_key INTEGER PRIMARY KEY,
+    area REAL,
+    rooms INTEGER,
+    floor TEXT,
+    fetched REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ad_details_fetched ON ad_details (fetched);
+"""
+
+def parse_details(content: bytes, encoding: str) -> dict:
+    """Площадь, комнаты и этаж со страницы объявления tap.az / bina.az.
+    Оба сайта выводят характеристики списком product-properties__i (название и значение)."""
+    soup = parse_html(content, encoding)
+    details = {'area': None, 'rooms': None, 'floor': None}
+
+    for prop in soup.find_all(None, class_='product-properties__i'):
+        name = prop.find(None, class_='product-properties__i-name')
+        value = prop.find(None, class_='product-properties__i-value')
+        if not name or not value:
+            continue
+        name = name.text.strip().lower()
+        value = value.text.strip()
+        if 'sahə' in name:
+            details['area'] = parse_price(value)
+        elif 'otaq' in name:
+            rooms = parse_price(value)
+            details['rooms'] = int(rooms) if rooms is not None else None
+        elif 'mərtəbə' in name:
+            details['floor'] = value.replace(' ', '')
+    return details
+
+class DetailCache(SqliteBacked):
+    """Поля со страниц объявлений, сохраненные по числовому ключу объявления: страница
+    каждого объявления загружается один раз, сколько бы пользователей и проверок его ни видели"""
+
+    schema = SCHEMA
+
+    def __init__(self, path: str = DB_FILE, concurrency: int = 4, capacity: int = 50000):
+        super().__init__(path)
+        self.concurrency = concurrency
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._inflight = {}  # ad_key -> Event: страница уже загружается другим потоком
+        self._writes = 0
+
+    def _load(self, keys: List[int]) -> Dict[int, dict]:
+        rows = {}
+        conn = self._connection()
+        # Запрос кусками: у SQLite ограничено число параметров
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for key, area, rooms, floor in conn.execute(
+                f'SELECT ad_key, area, rooms, floor FROM ad_details WHERE ad_key IN ({placeholders})', chunk
+            ):
+                rows[key] = {'area': area, 'rooms': rooms, 'floor': floor}
+        return rows
+
+    def _save(self, details: Dict[int, dict]) -> None:
+        now = time.time()
+        with self._connection() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO ad_details (ad_key, area, rooms, floor, fetched) VALUES (?, ?, ?, ?, ?)',
+                [(key, d['area'], d['rooms'], d['floor'], now) for key, d in details.items()]
+            )
+            self._writes += len(details)
+            # Чистим не на каждой записи, а примерно раз в тысячу
+            if self._writes >= 1000:
+                self._writes = 0
+                conn.execute(
+                    'DELETE FROM ad_details WHERE ad_key IN ('
+                    'SELECT ad_key FROM ad_details ORDER BY fetched DESC LIMIT -1 OFFSET ?)',
+                    (self.capacity,)
+                )
+
+    def _fetch(self, listings: List[Listing]) -> Dict[int, dict]:
+        """Загружает страницы объявлений пачками по concurrency штук"""
+        fetched = {}
+        for start in range(0, len(listings), self.concurrency):
+            chunk = listings[start:start + self.concurrency]
+            responses = fetch_engine.fetch_all_sync([listing.link for listing in chunk])
+            for listing, response in zip(chunk, responses):
+                if isinstance(response, Exception):
+                    print(f"Ошибка при загрузке страницы объявления {listing.link}: {str(response)}")
+                    continue
+                try:
+                    fetched[ad_key(listing.link)] = parse_details(response.content, page_encoding(response.headers))
+                except Exception as e:
+                    print(f"Ошибка при разборе страницы объявления {listing.link}: {str(e)}")
+        return fetched
+
+    def enrich(self, listings: List[Listing]) -> None:
+        """Дополняет объявления полями с их страниц: из кэша или загружая недостающие параллельно"""
+        listings = [listing for listing in listings if listing.link]
+        if not listings:
+            return
+        by_key = {}
+        for listing in listings:
+            by_key.setdefault(ad_key(listing.link), []).append(listing)
+        details = self._load(list(by_key))
+
+        # Недостающие страницы загружает тот, кто первым их запросил; остальные ждут его
+        claimed, waiting = [], []
+        with self._lock:
+            for key in by_key:
+                if key in details:
+                    continue
+                event = self._inflight.get(key)
+                if event is None:
+                    self._inflight[key] = threading.Event()
+                    claimed.append(key)
+                else:
+                    waiting.append(event)
+
+        if claimed:
+            try:
+                fetched = self._fetch([by_key[key][0] for key in claimed])
+                if fetched:
+                    self._save(fetched)
+                details.update(fetched)
+                print(f"Загружены страницы объявлений: {len(fetched)} из {len(claimed)}")
+            finally:
+                with self._lock:
+                    for key in claimed:
+                        self._inflight.pop(key).set()
+        if waiting:
+            for event in waiting:
+                event.wait(60)
+            details.update(self._load([key for key in by_key if key not in details]))
+
+        for key, detail in details.items():
+            for listing in by_key.get(key, ()):
+                listing.set_details(detail['area'], detail['rooms'], detail['floor'])
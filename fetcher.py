@@ -0,0 +1,298 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+# Размер пула keep-alive соединений на один хост
+POOL_SIZE = 10
+# Сколько запросов может выполняться одновременно
+MAX_WORKERS = 16
+# Таймаут запроса в секундах
+REQUEST_TIMEOUT = 10
+# Максимальный размер ответа (байт), в том числе страниц объявлений
+MAX_RESPONSE_BYTES = 5 * 1024 * 1024
+# Размер куска при потоковой загрузке (байт)
+CHUNK_SIZE = 16 * 1024
+# Бюджет на один хост (общий для всего процесса): запросов в секунду, запас и одновременных запросов
+HOST_RATE = 2.0
+HOST_BURST = 4
+HOST_CONCURRENCY = 4
+# Замедление хоста после 429/503: первая пауза и максимум (сек), минимальная скорость (запросов в секунду)
+BACKOFF_START = 5
+BACKOFF_MAX = 300
+MIN_HOST_RATE = 0.1
+# Ответы, которыми сайт просит сбавить темп
+THROTTLE_STATUSES = (429, 503)
+
+def trim_utf8(data: bytes) -> bytes:
+    """Отрезает неполный символ UTF-8 в конце оборванного тела: иначе парсер не узнает
+    кодировку страницы и испортит все азербайджанские буквы"""
+    for back in range(1, min(4, len(data)) + 1):
+        byte = data[-back]
+        if byte & 0xC0 == 0x80:
+            continue  # байт продолжения - ищем начало символа
+        size = 1 if byte < 0x80 else 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+        return data if back >= size else data[:-back]
+    return data
+
+class ResponseTooLarge(Exception):
+    """Ответ больше допустимого размера (повторять запрос бессмысленно)"""
+
+def get_random_user_agent() -> str:
+    """Return a random user agent string."""
+    user_agents = [
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/92.0.4515.107 Safari/537.36',
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:90.0) Gecko/20100101 Firefox/90.0',
+        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Safari/605.1.15',
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36'
+    ]
+    return random.choice(user_agents)
+
+def build_headers() -> Dict[str, str]:
+    """Заголовки запроса (для каждой попытки свой User-Agent)"""
+    return {
+        'User-Agent': get_random_user_agent(),
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+        'Accept-Language': 'az-AZ,az;q=0.9,en-US;q=0.8,en;q=0.7',
+        'Connection': 'keep-alive',
+        'Upgrade-Insecure-Requests': '1',
+        'Cache-Control': 'no-cache'
+    }
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After в секундах: число или HTTP-дата"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class HostBudget:
+    """Бюджет запросов к одному хосту: ведро токенов, ограничение одновременных запросов
+    и общая для хоста пауза после 429/503. Скорость при ошибках уменьшается вдвое,
+    а после успешных ответов постепенно восстанавливается. Используется только
+    из цикла событий движка, поэтому без блокировок."""
+
+    def __init__(self, host: str, rate: float, burst: int, concurrency: int):
+        self.host = host
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.blocked_until = 0.0
+        self.penalty = 0  # сколько раз подряд сайт просил сбавить темп
+
+    async def acquire(self) -> None:
+        """Ждет паузы хоста и свободного токена"""
+        while True:
+            now = time.monotonic()
+            wait = self.blocked_until - now
+            if wait <= 0:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    def throttled(self, retry_after: Optional[float]) -> float:
+        """Сайт ответил 429/503: пауза для всего хоста (не меньше Retry-After) растет
+        экспоненциально, скорость уменьшается вдвое. Возвращает длину паузы."""
+        self.penalty += 1
+        delay = min(BACKOFF_MAX, BACKOFF_START * 2 ** (self.penalty - 1))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, BACKOFF_MAX))
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        self.rate = max(MIN_HOST_RATE, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+        return delay
+
+    def healthy(self) -> None:
+        """Успешный ответ: скорость постепенно возвращается к исходной"""
+        if self.penalty:
+            self.penalty -= 1
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+class FetchEngine:
+    """Загрузка страниц через пулы keep-alive соединений (по одному на хост) на asyncio"""
+
+    def __init__(self, pool_size: int = POOL_SIZE, max_workers: int = MAX_WORKERS):
+        self._pool_size = pool_size
+        self._sessions = {}  # host -> requests.Session
+        self._budgets = {}  # host -> HostBudget (создаются в цикле событий)
+        self._host_limits = (HOST_RATE, HOST_BURST, HOST_CONCURRENCY)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fetch')
+        self._loop = None
+        self._thread = None
+
+    def _session(self, url: str) -> requests.Session:
+        """Сессия с пулом соединений для хоста (DNS/TCP/TLS не повторяются между запросами)"""
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[host] = session
+            return session
+
+    def set_host_limits(self, rate: float, burst: int, concurrency: int) -> None:
+        """Меняет бюджет хостов (действует для хостов, к которым еще не было запросов)"""
+        self._host_limits = (rate, burst, concurrency)
+
+    def _budget(self, url: str) -> HostBudget:
+        host = urlsplit(url).netloc.lower()
+        budget = self._budgets.get(host)
+        if budget is None:
+            budget = self._budgets[host] = HostBudget(host, *self._host_limits)
+        return budget
+
+    def _get(self, url: str, headers: Dict[str, str], timeout: float, scanner=None,
+             max_bytes: int = None) -> requests.Response:
+        # Потоковая загрузка: читаем тело кусками не больше max_bytes и обрываем,
+        # когда scanner скажет, что хватит
+        response = self._session(url).get(url, headers=headers, timeout=timeout, stream=True)
+        max_bytes = max_bytes or MAX_RESPONSE_BYTES
+        # Ответы об ошибке и 304 читаются тем же циклом: страница сайта не сканируется,
+        # а сверх max_bytes тело просто обрезается - важен статус, а не страница ошибки
+        page = response.status_code == 200
+        try:
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(CHUNK_SIZE):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > max_bytes:
+                    if not page:
+                        chunks = [trim_utf8(b''.join(chunks)[:max_bytes])]
+                        break
+                    raise ResponseTooLarge(f"Ответ {url} больше {max_bytes} байт")
+                if page and scanner is not None and scanner.feed_bytes(chunk):
+                    print(f"Загрузка {url} остановлена досрочно после {size} байт")
+                    # Оборвали посреди страницы - возможно, и посреди символа
+                    chunks = [trim_utf8(b''.join(chunks))]
+                    break
+                    
+            response._content = b''.join(chunks)
+            response._content_consumed = True
+            return response
+        finally:
+            # Недочитанное соединение закрывается, а не возвращается в пул
+            response.close()
+
+    async def fetch(self, url: str, max_retries: int = 3, headers_factory: Callable[[], Dict[str, str]] = build_headers,
+                    timeout: float = REQUEST_TIMEOUT, extra_headers: Dict[str, str] = None,
+                    scanner_factory: Callable[[], object] = None, max_bytes: int = None) -> requests.Response:
+        """Make a request with retries and random delays.
+        Все запросы к хосту проходят через его бюджет; после 429/503 ждет весь хост.
+        scanner_factory создает объект с методом feed_bytes(chunk) -> bool: тело читается
+        потоково и загрузка обрывается, как только он вернет True. max_bytes ограничивает
+        размер любого ответа (по умолчанию MAX_RESPONSE_BYTES)."""
+        loop = asyncio.get_running_loop()
+        budget = self._budget(url)
+        throttled = False
+        for attempt in range(max_retries):
+            try:
+                # Добавляем случайную задержку между попытками (не блокируя другие запросы);
+                # после 429/503 паузу задает бюджет хоста
+                if attempt > 0 and not throttled:
+                    delay = random.uniform(2, 5)
+                    print(f"Попытка {attempt + 1} после задержки {delay:.1f} сек")
+                    await asyncio.sleep(delay)
+
+                headers = headers_factory()
+                if extra_headers:
+                    headers.update(extra_headers)
+                scanner = scanner_factory() if scanner_factory else None
+                throttled = False
+                async with budget.semaphore:
+                    await budget.acquire()
+                    response = await loop.run_in_executor(
+                        self._executor, self._get, url, headers, timeout, scanner, max_bytes
+                    )
+                    
+                throttled = response.status_code in THROTTLE_STATUSES
+                if throttled:
+                    pause = budget.throttled(parse_retry_after(response.headers.get('Retry-After')))
+                    print(f"{budget.host} просит сбавить темп ({response.status_code}): пауза {pause:.0f} сек, "
+                          f"скорость {budget.rate:.2f} запр./сек")
+                elif response.status_code < 500:
+                    budget.healthy()
+                response.raise_for_status()
+                return response
+
+            except requests.exceptions.RequestException as e:
+                if attempt == max_retries - 1:  # Последняя попытка
+                    raise
+                print(f"Попытка {attempt + 1} не удалась: {str(e)}")
+                continue
+
+    async def fetch_all(self, urls: List[str], extra_headers: List[Dict[str, str]] = None,
+                        scanner_factories: List[Callable[[], object]] = None, **kwargs) -> list:
+        """Загружает несколько URL одновременно; вместо ответа может быть исключение.
+        extra_headers и scanner_factories - необязательные списки параметров для каждого URL."""
+        extra_headers = extra_headers or [None] * len(urls)
+        scanner_factories = scanner_factories or [None] * len(urls)
+        return await asyncio.gather(
+            *(self.fetch(url, extra_headers=headers, scanner_factory=scanner_factory, **kwargs)
+              for url, headers, scanner_factory in zip(urls, extra_headers, scanner_factories)),
+            return_exceptions=True
+        )
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """Запускает фоновый цикл событий, на котором выполняются все загрузки"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name='fetch-loop', daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def run(self, coro):
+        """Синхронная обертка: выполняет корутину на фоновом цикле и ждет результат"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop()).result()
+
+    def fetch_sync(self, url: str, **kwargs) -> requests.Response:
+        """Синхронная версия fetch для кода, работающего в потоках"""
+        return self.run(self.fetch(url, **kwargs))
+
+    def fetch_all_sync(self, urls: List[str], **kwargs) -> list:
+        """Синхронная версия fetch_all"""
+        return self.run(self.fetch_all(urls, **kwargs))
+
+    def close(self) -> None:
+        """Закрывает соединения и останавливает фоновый цикл"""
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._budgets.clear()
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop = None
+                self._thread = None
+
+# Общий движок загрузки для всего процесса
+engine = FetchEngine()
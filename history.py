@@ -0,0 +1,158 @@
+import hashlib
+import math
+import re
+import threading
+from array import array
+from typing import Iterable, List, Tuple
+from urllib.parse import urlsplit
+
+# Сколько отправленных объявлений помним для каждого пользователя
+HISTORY_CAPACITY = 50000
+# С какого размера начинается фильтр Блума: он растет вдвое по мере заполнения истории,
+# чтобы у пользователей с короткой историей не занимать память под HISTORY_CAPACITY ключей
+BLOOM_MIN_CAPACITY = 64
+
+# Код сайта хранится в младших битах ключа, чтобы id разных сайтов не совпадали
+SITE_CODES = {'tap.az': 1, 'bina.az': 2}
+# Числовой id объявления - последний числовой сегмент пути (/elanlar/.../44248296, /items/5072419)
+AD_ID_RE = re.compile(r'/(\d+)/?$')
+
+MASK64 = (1 << 64) - 1
+
+def ad_key(link: str) -> int:
+    """Компактный числовой ключ объявления по ссылке"""
+    parts = urlsplit(link)
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    match = AD_ID_RE.search(parts.path)
+    code = SITE_CODES.get(host)
+    if match and code:
+        return int(match.group(1)) * 4 + code
+    # Ссылка без числового id - используем хэш (код сайта 0)
+    digest = hashlib.blake2b(link.encode('utf-8'), digest_size=8).digest()
+    return (int.from_bytes(digest, 'big') >> 4) * 4
+
+class BloomFilter:
+    """Битовый фильтр Блума над целыми ключами: быстрый ответ "точно не было" """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: int):
+        # Двойное хэширование: h1 + i * h2
+        h1 = (key * 0x9E3779B97F4A7C15) & MASK64
+        h2 = (((key ^ (key >> 31)) * 0xBF58476D1CE4E5B9) & MASK64) | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: int) -> None:
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: int) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+class SentHistory:
+    """История отправленных объявлений пользователя: числовые ключи в порядке добавления
+    (старые вытесняются при переполнении) и фильтр Блума перед точной проверкой"""
+
+    def __init__(self, capacity: int = HISTORY_CAPACITY, expected: int = 0):
+        self.capacity = capacity
+        self._order = array('q')  # ключи по порядку добавления
+        self._head = 0  # индекс самого старого живого ключа в _order
+        self._keys = set()
+        # expected - сколько ключей будет загружено сразу: фильтр создается с запасом под них
+        self._bloom_capacity = min(capacity, max(expected * 2, BLOOM_MIN_CAPACITY))
+        self._bloom = BloomFilter(self._bloom_capacity)
+        self._evicted = 0  # вытеснено с последней перестройки фильтра
+        self._next_seq = 0  # порядковый номер следующего ключа (для хранения в базе)
+        self._saved_seq = 0  # ключи с меньшими номерами уже сохранены
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[int, int]], capacity: int = HISTORY_CAPACITY) -> 'SentHistory':
+        """Восстанавливает историю из строк базы (seq, key), отсортированных по seq"""
+        rows = list(rows)
+        history = cls(capacity, len(rows))
+        first = True
+        for seq, key in rows:
+            if first:
+                history._next_seq = seq
+                first = False
+            history._add_key(key)
+        history._saved_seq = history._next_seq
+        return history
+
+    @classmethod
+    def from_links(cls, links: Iterable[str], capacity: int = HISTORY_CAPACITY) -> 'SentHistory':
+        """Переводит старый список ссылок в историю по числовым ключам"""
+        links = list(links)
+        history = cls(capacity, len(links))
+        for link in links:
+            history.add(link)
+        return history
+
+    def __contains__(self, link: str) -> bool:
+        key = ad_key(link)
+        with self._lock:
+            # Фильтр Блума отвечает "точно нет" без обращения к множеству
+            return key in self._bloom and key in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, link: str) -> bool:
+        """Добавляет объявление; False - оно уже было в истории"""
+        key = ad_key(link)
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._add_key(key)
+            return True
+
+    def _add_key(self, key: int) -> None:
+        self._order.append(key)
+        self._keys.add(key)
+        self._bloom.add(key)
+        self._next_seq += 1
+        while len(self._keys) > self.capacity:
+            self._keys.discard(self._order[self._head])
+            self._head += 1
+            self._evicted += 1
+
+        # Сжимаем массив, когда вытесненных стало больше половины
+        if self._head > len(self._order) // 2:
+            self._order = self._order[self._head:]
+            self._head = 0
+        # Фильтр заполнен - перестраиваем вдвое большим, иначе растет доля ложных срабатываний
+        if len(self._keys) > self._bloom_capacity:
+            self._rebuild_bloom(min(self.capacity, self._bloom_capacity * 2))
+        # Из фильтра Блума удалять нельзя - периодически перестраиваем его по живым ключам
+        elif self._evicted > self.capacity // 2:
+            self._rebuild_bloom(self._bloom_capacity)
+
+    def _rebuild_bloom(self, capacity: int) -> None:
+        self._bloom_capacity = capacity
+        self._bloom = BloomFilter(capacity)
+        for live_key in self._keys:
+            self._bloom.add(live_key)
+        self._evicted = 0
+
+    def unsaved_rows(self) -> Tuple[List[Tuple[int, int]], int, int]:
+        """Несохраненные строки (seq, key), номер самого старого живого ключа
+        и номер, до которого все будет сохранено после записи этих строк"""
+        with self._lock:
+            live = len(self._order) - self._head
+            first_seq = self._next_seq - live
+            start = max(self._saved_seq, first_seq)
+            offset = self._head + (start - first_seq)
+            rows = list(zip(range(start, self._next_seq), self._order[offset:]))
+            return rows, first_seq, self._next_seq
+
+    def mark_saved(self, seq: int) -> None:
+        """Отмечает, что ключи с номерами меньше seq записаны в базу"""
+        with self._lock:
+            self._saved_seq = max(self._saved_seq, seq)
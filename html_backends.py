@@ -0,0 +1,122 @@
+import time
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml  # noqa: F401 - нужен только как построитель дерева для BeautifulSoup
+except ImportError:
+    lxml = None
+
+try:
+    from selectolax.parser import HTMLParser as SelectolaxParser
+except ImportError:
+    SelectolaxParser = None
+
+# Кодировка страниц tap.az / bina.az, если сервер не указал charset
+DEFAULT_ENCODING = 'utf-8'
+
+# Доступные парсеры: 'html.parser' (чистый Python, запасной), 'lxml', 'selectolax'
+BACKENDS = ('html.parser', 'lxml', 'selectolax')
+
+_backend = 'lxml'
+_partial = True
+
+class SelectolaxNode:
+    """Узел selectolax с тем же интерфейсом, что и у тегов BeautifulSoup,
+    чтобы код разбора объявлений работал без изменений"""
+
+    __slots__ = ('_node',)
+
+    def __init__(self, node):
+        self._node = node
+
+    @staticmethod
+    def _selector(name: str, class_: str = None) -> str:
+        return f'{name or ""}.{class_}' if class_ else name
+
+    def find(self, name: str, class_: str = None):
+        node = self._node.css_first(self._selector(name, class_))
+        return SelectolaxNode(node) if node is not None else None
+
+    def find_all(self, name: str, class_: str = None) -> list:
+        return [SelectolaxNode(node) for node in self._node.css(self._selector(name, class_))]
+
+    def get(self, attr: str, default=None):
+        value = self._node.attributes.get(attr)
+        return default if value is None else value
+
+    @property
+    def text(self) -> str:
+        return self._node.text(deep=True)
+
+def available(backend: str) -> bool:
+    """Установлена ли библиотека для парсера"""
+    if backend == 'lxml':
+        return lxml is not None
+    if backend == 'selectolax':
+        return SelectolaxParser is not None
+    return backend == 'html.parser'
+
+def set_backend(backend: str) -> str:
+    """Выбирает парсер; если он не установлен, остается html.parser. Возвращает выбранный."""
+    global _backend
+    if backend not in BACKENDS:
+        print(f"Неизвестный парсер HTML '{backend}', используется html.parser")
+        backend = 'html.parser'
+    elif not available(backend):
+        print(f"Парсер HTML '{backend}' не установлен, используется html.parser")
+        backend = 'html.parser'
+    _backend = backend
+    return backend
+
+def set_partial(enabled: bool) -> None:
+    """Включает разбор только контейнеров объявлений вместо всей страницы"""
+    global _partial
+    _partial = enabled
+
+def is_partial() -> bool:
+    """Включен ли разбор только контейнеров объявлений"""
+    return _partial
+
+def get_backend() -> str:
+    """Текущий парсер HTML"""
+    return _backend if available(_backend) else 'html.parser'
+
+def page_encoding(headers) -> str:
+    """Кодировка страницы из Content-Type (без угадывания по содержимому)"""
+    content_type = headers.get('Content-Type', '')
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'charset' and value:
+            return value.strip('"\' ')
+    return DEFAULT_ENCODING
+
+def class_matcher(classes) -> callable:
+    """Условие для SoupStrainer: у тега есть хотя бы один из классов. Во время разбора
+    SoupStrainer получает атрибут class целой строкой ("products-i vipped"), поэтому
+    список классов сравнивается по отдельным словам."""
+    wanted = set(classes)
+    return lambda value: bool(value) and not wanted.isdisjoint(value.split())
+
+def parse_html(content: bytes, encoding: str = DEFAULT_ENCODING, backend: str = None, only: tuple = None,
+               partial: bool = None):
+    """Строит дерево страницы из байтов выбранным парсером и пишет время разбора в лог.
+    only=(тег, [классы]) - строить узлы только внутри этих контейнеров (шапка, скрипты,
+    сайдбары и подвал в дерево не попадают). partial - явно включить/выключить такой
+    разбор (по умолчанию - настройка set_partial)."""
+    backend = backend or get_backend()
+    partial = _partial if partial is None else partial
+    started = time.perf_counter()
+
+    if backend == 'selectolax':
+        # selectolax строит дерево целиком на C, ограничение ему не нужно
+        tree = SelectolaxNode(SelectolaxParser(content.decode(encoding, errors='replace')).root)
+    elif only and partial:
+        name, classes = only
+        tree = BeautifulSoup(content, backend, from_encoding=encoding,
+                             parse_only=SoupStrainer(name, class_=class_matcher(classes)))
+    else:
+        tree = BeautifulSoup(content, backend, from_encoding=encoding)
+
+    elapsed = time.perf_counter() - started
+    print(f"Разбор страницы ({backend}): {elapsed * 1000:.1f} мс")
+    return tree
@@ -0,0 +1,102 @@
+import re
+from typing import Optional
+from urllib.parse import urlsplit
+from history import AD_ID_RE
+
+# Число в тексте цены: "1 200 AZN", "450 AZN/ay", "1.200,50"
+PRICE_RE = re.compile(r'\d[\d\s .,]*')
+
+def parse_price(text: str) -> Optional[float]:
+    """Цена из текста объявления как число (None, если цены нет)"""
+    match = PRICE_RE.search(text or '')
+    if not match:
+        return None
+    number = re.sub(r'[\s ]', '', match.group(0)).rstrip('.,')
+    # Точка или запятая с тремя цифрами после - разделитель тысяч, иначе - дробная часть
+    number = re.sub(r'[.,](?=\d{3}(?:[.,]|$))', '', number).replace(',', '.')
+    try:
+        return float(number)
+    except ValueError:
+        return None
+
+def parse_ad_id(link: str) -> Optional[int]:
+    """Числовой id объявления из ссылки"""
+    match = AD_ID_RE.search(urlsplit(link).path)
+    return int(match.group(1)) if match else None
+
+class Listing:
+    """Одно объявление: разбирается один раз, сообщение форматируется один раз
+    и переиспользуется для всех получателей"""
+
+    __slots__ = ('ad_id', 'site', 'title', 'location', 'region', 'price', 'price_text',
+                 'photo_url', 'link', 'pinned', 'area', 'rooms', 'floor', '_message', '_search')
+
+    def __init__(self, site: str, title: str, location: str, price_text: str, photo_url: Optional[str],
+                 link: str, region: str = '', pinned: bool = False):
+        self.ad_id = parse_ad_id(link)
+        self.site = site
+        self.title = title
+        self.location = location
+        self.region = region  # район (tap.az), используется только в фильтрах
+        self.price_text = price_text
+        self.price = parse_price(price_text)
+        self.photo_url = photo_url
+        self.link = link
+        self.pinned = pinned
+        # Поля со страницы объявления (заполняются при ENRICH_DETAILS)
+        self.area = None
+        self.rooms = None
+        self.floor = None
+        self._message = None
+        self._search = None
+
+    def set_details(self, area: Optional[float], rooms: Optional[int], floor: Optional[str]) -> None:
+        """Добавляет поля со страницы объявления (сообщение будет сформировано заново)"""
+        self.area = area
+        self.rooms = rooms
+        self.floor = floor
+        self._message = None
+
+    def search_text(self) -> tuple:
+        """Заголовок и местоположение с районом в нижнем регистре - для фильтров (один раз на объявление)"""
+        if self._search is None:
+            self._search = (self.title.lower(), (self.location + '\n' + self.region).lower())
+        return self._search
+
+    def render(self) -> str:
+        """Текст сообщения (форматируется при первом обращении)"""
+        if self._message is None:
+            message = f"🏠 {self.title}\n"
+            message += f"📍 {self.location}\n"
+            details = []
+            if self.rooms:
+                details.append(f"{self.rooms} комн.")
+            if self.area:
+                details.append(f"{self.area:g} м²")
+            if self.floor:
+                details.append(f"этаж {self.floor}")
+            if details:
+                message += f"📐 {', '.join(details)}\n"
+            message += f"💰 {self.price_text}\n"
+            message += f"🔗 {self.link}"
+            self._message = message
+        return self._message
+
+    def row(self) -> tuple:
+        """Компактный кортеж для передачи между процессами"""
+        return (self.site, self.title, self.location, self.price_text, self.photo_url,
+                self.link, self.region, self.pinned)
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'Listing':
+        """Объявление из кортежа row()"""
+        return cls(*row)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Listing) and (self.site, self.link) == (other.site, other.link)
+
+    def __hash__(self) -> int:
+        return hash((self.site, self.link))
+
+    def __repr__(self) -> str:
+        return f"Listing({self.site}, {self.ad_id}, {self.title!r}, {self.price_text!r})"
@@ -0,0 +1,252 @@
+import math
+import re
+import threading
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Числовые поля объявления, по которым пользователь задает диапазоны (/limits)
+LIMIT_FIELDS = ('price', 'rooms', 'area')
+# Поля, известные только со страницы объявления (ENRICH_DETAILS)
+DETAIL_FIELDS = ('rooms', 'area')
+
+def normalize(text: str) -> str:
+    """Текст для сравнения с фильтрами (так же, как его нормализовали раньше - lower)"""
+    return (text or '').lower()
+
+def compile_terms(terms: Iterable[str]) -> Optional[re.Pattern]:
+    """Одно регулярное выражение для всех слов фильтра (None - фильтров нет).
+    Длинные слова идут первыми, пустые пропускаются."""
+    words = sorted({normalize(term) for term in terms if term and term.strip()}, key=len, reverse=True)
+    if not words:
+        return None
+    return re.compile('|'.join(re.escape(word) for word in words))
+
+class FilterMatcher:
+    """Фильтры пользователя, собранные заранее: одно выражение на заголовок и одно
+    на местоположение, проверка объявления - один проход по каждому тексту"""
+
+    __slots__ = ('title_re', 'location_re')
+
+    def __init__(self, filters: dict = None):
+        filters = filters or {}
+        self.title_re = compile_terms(filters.get('title', []))
+        self.location_re = compile_terms(filters.get('location', []))
+
+    def title_blocked(self, text: str) -> bool:
+        """Заголовок (уже нормализованный) содержит слово из фильтра"""
+        return self.title_re is not None and self.title_re.search(text) is not None
+
+    def location_blocked(self, text: str) -> bool:
+        """Местоположение (уже нормализованное) содержит слово из фильтра"""
+        return self.location_re is not None and self.location_re.search(text) is not None
+
+    def passes(self, listing) -> bool:
+        """True - объявление подходит пользователю"""
+        title, location = listing.search_text()
+        return not (self.title_blocked(title) or self.location_blocked(location))
+
+    def __bool__(self) -> bool:
+        return self.title_re is not None or self.location_re is not None
+
+class AhoCorasick:
+    """Автомат Ахо-Корасик: все слова находятся за один проход по тексту,
+    сколько бы слов ни было"""
+
+    def __init__(self, words: List[str]):
+        self._goto = [{}]  # переходы по символам
+        self._fail = [0]  # куда переходить, если символа нет
+        self._out = [()]  # номера слов, которые заканчиваются в узле
+        for index, word in enumerate(words):
+            node = 0
+            for char in word:
+                child = self._goto[node].get(char)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto[node][char] = child
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                node = child
+            self._out[node] += (index,)
+
+        # Ссылки неудач строятся обходом в ширину
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._out[child] += self._out[self._fail[child]]
+
+    def find(self, text: str) -> Set[int]:
+        """Номера всех слов, встречающихся в тексте"""
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+class FilterIndex:
+    """Обратный индекс фильтров всех подписчиков поиска: слово -> пользователи, у которых
+    оно есть. Текст объявления просматривается один раз, и сразу известны все
+    пользователи, которым оно не подходит - независимо от числа подписчиков."""
+
+    def __init__(self, filters_by_user: Dict[int, dict]):
+        self._fields = []  # (поле, автомат, пользователи по номеру слова)
+        for field in ('title', 'location'):
+            users_by_term = {}
+            for user_id, filters in filters_by_user.items():
+                for term in (filters or {}).get(field, []):
+                    term = normalize(term)
+                    if term.strip():
+                        users_by_term.setdefault(term, set()).add(user_id)
+            if users_by_term:
+                terms = list(users_by_term)
+                self._fields.append((field, AhoCorasick(terms), [frozenset(users_by_term[term]) for term in terms]))
+
+    def excluded(self, listing) -> Set[int]:
+        """Пользователи, фильтры которых отсеивают объявление"""
+        title, location = listing.search_text()
+        excluded = set()
+        for field, automaton, users in self._fields:
+            for index in automaton.find(title if field == 'title' else location):
+                excluded |= users[index]
+        return excluded
+
+def parse_range(text: str) -> Tuple[Optional[float], Optional[float]]:
+    """Диапазон из текста: "300-800", "300-" (от), "-800" (до), "2" (ровно).
+    ValueError - если это не диапазон."""
+    text = text.replace(' ', '').replace(',', '.')
+    if '-' in text:
+        low, high = text.split('-', 1)
+    else:
+        low = high = text
+    low = float(low) if low else None
+    high = float(high) if high else None
+    if low is None and high is None:
+        raise ValueError('пустой диапазон')
+    if any(bound is not None and not math.isfinite(bound) for bound in (low, high)):
+        raise ValueError('границы диапазона должны быть числами')
+    if low is not None and high is not None and low > high:
+        raise ValueError('начало диапазона больше конца')
+    return low, high
+
+class LimitsMatrix:
+    """Числовые диапазоны подписчиков (цена, комнаты, площадь). Вся пачка объявлений
+    проверяется сразу для всех подписчиков: с NumPy - одной маской подписчики x объявления,
+    без нее - обычным циклом. Неизвестное значение (нет цены, страница не загружена)
+    диапазон не отсеивает."""
+
+    def __init__(self, limits_by_user: Dict[int, dict]):
+        # Пользователи без диапазонов в матрицу не попадают: им подходит все
+        self.user_ids = []
+        self._bounds = []  # по пользователю: [(от, до)] по LIMIT_FIELDS, None - без границы
+        self.needs_details = False
+        for user_id, limits in limits_by_user.items():
+            if not limits:
+                continue
+            bounds = []
+            for field in LIMIT_FIELDS:
+                low, high = limits.get(field) or (None, None)
+                bounds.append((low, high))
+                if field in DETAIL_FIELDS and (low is not None or high is not None):
+                    self.needs_details = True
+            self.user_ids.append(user_id)
+            self._bounds.append(bounds)
+
+    def __bool__(self) -> bool:
+        return bool(self.user_ids)
+
+    def mask(self, listings: list) -> dict:
+        """user_id -> какие объявления пачки подходят (по порядку); только для пользователей с диапазонами"""
+        if not self.user_ids or not listings:
+            return {}
+        if np is None:
+            return {
+                user_id: [self._fits(bounds, listing) for listing in listings]
+                for user_id, bounds in zip(self.user_ids, self._bounds)
+            }
+
+        values = np.array(
+            [[getattr(listing, field) for field in LIMIT_FIELDS] for listing in listings], dtype=float
+        )  # None становится NaN
+        low = np.array([[-np.inf if l is None else l for l, _ in bounds] for bounds in self._bounds])
+        high = np.array([[np.inf if h is None else h for _, h in bounds] for bounds in self._bounds])
+        # подписчики x объявления x поля
+        fits = (values[None, :, :] >= low[:, None, :]) & (values[None, :, :] <= high[:, None, :])
+        fits |= np.isnan(values)[None, :, :]
+        rows = fits.all(axis=2)
+        return {user_id: rows[i] for i, user_id in enumerate(self.user_ids)}
+
+    @staticmethod
+    def _fits(bounds: list, listing) -> bool:
+        for field, (low, high) in zip(LIMIT_FIELDS, bounds):
+            value = getattr(listing, field)
+            if value is None:
+                continue
+            if (low is not None and value < low) or (high is not None and value > high):
+                return False
+        return True
+
+class MatcherCache:
+    """Собранные фильтры пользователей. Версия пользователя увеличивается при изменении
+    его фильтров (bump), и фильтры собираются заново при следующей проверке."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}  # user_id -> версия фильтров
+        self._matchers = {}  # user_id -> (версия, FilterMatcher)
+        self._indexes = {}  # ключ поиска -> (подписчики и версии их фильтров, FilterIndex)
+
+    def bump(self, user_id: int) -> int:
+        """Отмечает, что фильтры пользователя изменились; возвращает новую версию"""
+        with self._lock:
+            version = self._versions.get(user_id, 0) + 1
+            self._versions[user_id] = version
+            self._matchers.pop(user_id, None)
+            return version
+
+    def get(self, user_id: int, filters: dict) -> FilterMatcher:
+        """Собранные фильтры пользователя текущей версии"""
+        with self._lock:
+            version = self._versions.get(user_id, 0)
+            cached = self._matchers.get(user_id)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+        matcher = FilterMatcher(filters)
+        with self._lock:
+            # Пока собирали, фильтры могли измениться - тогда не запоминаем
+            if self._versions.get(user_id, 0) == version:
+                self._matchers[user_id] = (version, matcher)
+        return matcher
+
+    def index(self, key: str, user_ids: List[int], get_filters: Callable[[int], dict]) -> FilterIndex:
+        """Обратный индекс фильтров подписчиков поиска key. Пересобирается, только если
+        сменились подписчики или чьи-то фильтры (по версиям)."""
+        with self._lock:
+            signature = tuple(sorted((user_id, self._versions.get(user_id, 0)) for user_id in user_ids))
+            cached = self._indexes.get(key)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+        index = FilterIndex({user_id: get_filters(user_id) for user_id in user_ids})
+        with self._lock:
+            self._indexes[key] = (signature, index)
+        return index
+
+    def drop_index(self, key: str) -> None:
+        """Удаляет индекс поиска, на который больше никто не подписан"""
+        with self._lock:
+            self._indexes.pop(key, None)
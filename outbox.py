@@ -0,0 +1,218 @@
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Optional
+from telegram.error import RetryAfter
+
+# Приоритеты: ответы на команды пользователя идут раньше рассылки автопроверки
+INTERACTIVE = 0
+AUTO = 1
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~1 в секунду в личный чат, 20 в минуту в группу
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+GROUP_RATE = 20 / 60
+CHAT_BURST = 3
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity. Отправка из нескольких
+    сообщений (альбом) берет сразу cost токенов и может уйти в долг - следующие подождут."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Сколько секунд ждать до появления токена (0 - можно отправлять)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float, cost: int = 1) -> None:
+        self._refill(now)
+        self.tokens -= cost
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class OutboxItem:
+    __slots__ = ('chat_id', 'send', 'priority', 'cost', 'on_sent', 'on_error', 'seq', 'enqueued')
+
+    def __init__(self, chat_id: int, send: Callable, priority: int, cost: int,
+                 on_sent: Optional[Callable], on_error: Optional[Callable], seq: int):
+        self.chat_id = chat_id
+        self.send = send
+        self.priority = priority
+        self.cost = cost
+        self.on_sent = on_sent
+        self.on_error = on_error
+        self.seq = seq
+        self.enqueued = time.monotonic()
+
+class ChatQueue:
+    """Очередь одного чата: сообщения чата уходят по порядку (внутри приоритета), по одному"""
+
+    def __init__(self, chat_id: int):
+        rate = GROUP_RATE if chat_id < 0 else CHAT_RATE
+        self.bucket = TokenBucket(rate, CHAT_BURST)
+        self.queues = (deque(), deque())  # по приоритетам INTERACTIVE, AUTO
+        self.hold_until = 0.0  # после 429 чат ждет retry_after
+        self.busy = False  # сообщение этого чата сейчас отправляется
+
+    def head(self) -> Optional[OutboxItem]:
+        for queue in self.queues:
+            if queue:
+                return queue[0]
+        return None
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues)
+
+class Outbox:
+    """Единая очередь исходящих сообщений Telegram. Обработчики только ставят отправку
+    в очередь; несколько потоков отправляют сообщения с учетом общего лимита бота,
+    лимитов каждого чата и retry_after из ответа 429."""
+
+    def __init__(self, workers: int = 4, global_rate: float = GLOBAL_RATE):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}  # chat_id -> ChatQueue
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._stats = {'sent': 0, 'failed': 0, 'rate_limited': 0}
+        self._waits = []  # время ожидания в очереди с прошлого отчета
+        self._threads = [
+            threading.Thread(target=self._run, name=f'outbox-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, chat_id: int, send: Callable, priority: int = AUTO, cost: int = 1,
+               on_sent: Callable = None, on_error: Callable = None) -> None:
+        """Ставит отправку в очередь. send() вызывается в потоке очереди; on_sent получает
+        ее результат, on_error - исключение (кроме 429: тогда отправка повторяется сама)"""
+        item = OutboxItem(chat_id, send, priority, cost, on_sent, on_error, next(self._seq))
+        with self._cond:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = ChatQueue(chat_id)
+            chat.queues[priority].append(item)
+            self._cond.notify()
+
+    def _pick(self, now: float):
+        """Выбирает готовое к отправке сообщение: сначала по приоритету, затем самое старое.
+        Возвращает (сообщение, None) или (None, сколько ждать)"""
+        wait = self._global.wait_time(now)
+        if wait > 0:
+            return None, wait
+
+        best = None
+        best_chat = None
+        wait = None
+        for chat_id, chat in list(self._chats.items()):
+            item = chat.head()
+            if item is None:
+                # Пустые очереди держим, пока ведро чата не наполнится, иначе лимит обнулится
+                if not chat.busy and chat.bucket.full(now):
+                    del self._chats[chat_id]
+                continue
+            if chat.busy:
+                continue
+            chat_wait = max(chat.bucket.wait_time(now), chat.hold_until - now)
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+            if best is None or (item.priority, item.seq) < (best.priority, best.seq):
+                best, best_chat = item, chat
+
+        if best is None:
+            return None, wait
+        best_chat.queues[best.priority].popleft()
+        best_chat.busy = True
+        best_chat.bucket.take(now, best.cost)
+        self._global.take(now, best.cost)
+        return best, None
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping and not any(self._chats.values()):
+                        return
+                    item, wait = self._pick(time.monotonic())
+                    if item is not None:
+                        break
+                    self._cond.wait(wait)
+            self._deliver(item)
+
+    def _deliver(self, item: OutboxItem) -> None:
+        try:
+            result = item.send()
+        except RetryAfter as e:
+            # Telegram просит подождать: сообщение возвращается в начало очереди чата
+            print(f"Лимит Telegram для чата {item.chat_id}, повтор через {e.retry_after} сек.")
+            with self._cond:
+                chat = self._chats.get(item.chat_id)
+                if chat is None:
+                    chat = self._chats[item.chat_id] = ChatQueue(item.chat_id)
+                chat.queues[item.priority].appendleft(item)
+                chat.hold_until = time.monotonic() + e.retry_after
+                chat.busy = False
+                self._stats['rate_limited'] += 1
+                self._cond.notify_all()
+            return
+        except Exception as e:
+            self._finish(item, 'failed')
+            if item.on_error is not None:
+                self._callback(item.on_error, e)
+            else:
+                print(f"Ошибка при отправке сообщения в чат {item.chat_id}: {str(e)}")
+            return
+
+        self._finish(item, 'sent')
+        if item.on_sent is not None:
+            self._callback(item.on_sent, result)
+
+    def _finish(self, item: OutboxItem, outcome: str) -> None:
+        with self._cond:
+            chat = self._chats.get(item.chat_id)
+            if chat is not None:
+                chat.busy = False
+            self._stats[outcome] += 1
+            self._waits.append(time.monotonic() - item.enqueued)
+            self._cond.notify_all()
+
+    def _callback(self, callback: Callable, value) -> None:
+        try:
+            callback(value)
+        except Exception as e:
+            print(f"Ошибка в обработчике отправки: {str(e)}")
+
+    def stats(self) -> Dict[str, float]:
+        """Глубина очереди по приоритетам, счетчики и время ожидания с прошлого вызова"""
+        with self._cond:
+            waits, self._waits = self._waits, []
+            stats = dict(self._stats)
+            stats['interactive'] = sum(len(chat.queues[INTERACTIVE]) for chat in self._chats.values())
+            stats['auto'] = sum(len(chat.queues[AUTO]) for chat in self._chats.values())
+            stats['chats'] = sum(1 for chat in self._chats.values() if len(chat))
+        stats['avg_wait'] = sum(waits) / len(waits) if waits else 0.0
+        stats['max_wait'] = max(waits, default=0.0)
+        return stats
+
+    def close(self, timeout: float = 30) -> None:
+        """Дожидается отправки оставшихся сообщений (не дольше timeout) и останавливает потоки"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
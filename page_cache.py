@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable
+
+class PageCache:
+    """Общий для процесса кэш результатов парсинга с TTL, вытеснением LRU и single-flight:
+    одновременные запросы одного URL ждут уже идущую загрузку, а не запускают свою."""
+
+    def __init__(self, ttl: float = 60, max_entries: int = 256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (время истечения, результаты)
+        self._inflight = {}  # key -> Future текущей загрузки
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """Возвращает свежие результаты из кэша или None"""
+        with self._lock:
+            return self._get_locked(key)
+
+    def _get_locked(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value) -> None:
+        """Кладет результаты в кэш, вытесняя самые давно использованные записи"""
+        with self._lock:
+            self._put_locked(key, value)
+
+    def _put_locked(self, key: str, value) -> None:
+        if self.ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get_or_load(self, key: str, loader: Callable[[], object]):
+        """Возвращает результаты из кэша; при промахе загружает их ровно один раз"""
+        with self._lock:
+            value = self._get_locked(key)
+            if value is not None:
+                return value
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = Future()
+                self._inflight[key] = flight
+
+        # Загрузка уже идет в другом потоке - ждем ее результат (или ее ошибку)
+        if not leader:
+            return flight.result()
+
+        try:
+            value = loader()
+        except Exception as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.set_exception(e)
+            raise
+
+        with self._lock:
+            self._put_locked(key, value)
+            self._inflight.pop(key, None)
+        flight.set_result(value)
+        return value
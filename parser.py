@@ -1,15 +1,46 @@
 import requests
-from bs4 import BeautifulSoup
 from typing import Dict, List
-import random
+from fetcher import engine
+from html_backends import parse_html, page_encoding, get_backend, is_partial
+from listing import Listing
+from matching import FilterMatcher
+from history import ad_key
 import json
 import os
-import time
+import threading
+import codecs
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import urlsplit, urlunsplit, urljoin, parse_qsl, urlencode
 
 # Файл для хранения отправленных объявлений
 SENT_ADS_FILE = 'sent_ads.json'
-# Файл для хранения фильтров
-FILTERS_FILE = 'filters.json'
+
+# Контейнеры объявлений: при разборе строятся только они
+TAP_AZ_CONTAINERS = ('div', ['products-i'])
+BINA_AZ_CONTAINERS = ('div', ['items-i', 'items', 'items-i-vip'])
+
+# Сколько объявлений с начала страницы мы обрабатываем
+LISTING_LIMIT = 10
+
+# Для потоковой загрузки: классы блоков объявлений и класс ссылки на объявление
+TAP_AZ_SCAN = ({'products-i'}, 'products-link')
+BINA_AZ_SCAN = ({'items-i', 'items-i-vip'}, 'item_link')
+
+# Классы закрепленных объявлений: они стоят выше новых и не считаются уже виденными
+PINNED_CLASSES = {'vipped', 'featured', 'items-i-vip'}
+
+# Сколько ключей уже виденных объявлений поиска помнить между проверками: если объявление
+# прошлой проверки удалят, проверка остановится на следующем из виденных
+SEEN_KEEP = 50
+
+# Пул процессов для разбора страниц (None - разбор в потоке, который загрузил страницу)
+_process_pool = None
+
+# Валидаторы (ETag / Last-Modified) последней загрузки каждой страницы
+_validators = {}
+_validators_lock = threading.Lock()
 
 def load_sent_ads() -> set:
     """Загружает список отправленных объявлений"""
@@ -23,290 +54,470 @@ def save_sent_ads(ads: set) -> None:
     with open(SENT_ADS_FILE, 'w', encoding='utf-8') as f:
         json.dump(list(ads), f)
 
-def load_filters() -> dict:
-    """Загружает фильтры из файла"""
-    if os.path.exists(FILTERS_FILE):
-        with open(FILTERS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {'title': [], 'location': []}
-
-def save_filters(filters: dict) -> None:
-    """Сохраняет фильтры в файл"""
-    with open(FILTERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(filters, f)
-
-def apply_filters(title: str, location: str) -> bool:
-    """Проверяет, соответствует ли объявление фильтрам"""
-    filters = load_filters()
-    
-    # Проверяем фильтры по заголовку
-    for filter_text in filters['title']:
-        if filter_text.lower() in title.lower():
-            return False
-            
-    # Проверяем фильтры по местоположению
-    for filter_text in filters['location']:
-        if filter_text.lower() in location.lower():
-            return False
-            
-    return True
+def is_pinned(item) -> bool:
+    """Закрепленное (VIP / премиум) объявление висит сверху независимо от даты"""
+    classes = item.get('class') or []
+    if isinstance(classes, str):
+        classes = classes.split()
+    return bool(PINNED_CLASSES.intersection(classes))
 
-def add_filter(filter_type: str, filter_text: str) -> None:
-    """Добавляет новый фильтр"""
-    filters = load_filters()
-    
-    if filter_type in ['title', 'location']:
-        if filter_text not in filters[filter_type]:
-            filters[filter_type].append(filter_text)
-            save_filters(filters)
-
-def remove_filter(filter_type: str, filter_text: str) -> None:
-    """Удаляет фильтр"""
-    filters = load_filters()
+def listing_key(href: str, root: str) -> int:
+    """Ключ объявления для сравнения с уже виденными (seen): одинаковый для относительной
+    и полной ссылки и не зависит от параметров запроса"""
+    return ad_key(urljoin(root, urlsplit(href).path))
+
+def site_root(url: str) -> str:
+    """Адрес сайта для ссылок объявлений этого поиска"""
+    return 'https://tap.az' if 'tap.az' in url else 'https://bina.az'
+
+def canonical_url(url: str) -> str:
+    """Приводит URL поиска к каноническому виду, чтобы одинаковые поиски совпадали"""
+    parts = urlsplit(url.strip())
+    seen = set()
+    params = []
+    for key, value in parse_qsl(parts.query, keep_blank_values=True):
+        # Повторы скалярных параметров (q[keywords]=&q[keywords]=) выкидываем,
+        # а массивы (room_ids[]=1&room_ids[]=2) оставляем как есть - там важен порядок
+        if not key.endswith('[]'):
+            if (key, value) in seen:
+                continue
+            seen.add((key, value))
+        params.append((key, value))
+    # Сортировка стабильная, поэтому порядок значений внутри массива сохраняется
+    params.sort(key=lambda param: param[0])
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit((parts.scheme.lower() or 'https', parts.netloc.lower(), path, urlencode(params), ''))
+
+class ListingScanner(HTMLParser):
+    """Потоковый просмотр начала страницы: сообщает, когда прочитано нужное число
+    блоков объявлений или встретилось уже виденное (не закрепленное) объявление"""
     
-    if filter_type in ['title', 'location']:
-        if filter_text in filters[filter_type]:
-            filters[filter_type].remove(filter_text)
-            save_filters(filters)
-
-def get_filters() -> dict:
-    """Возвращает текущие фильтры"""
-    return load_filters()
-
-def get_random_user_agent() -> str:
-    """Return a random user agent string."""
-    user_agents = [
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/92.0.4515.107 Safari/537.36',
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:90.0) Gecko/20100101 Firefox/90.0',
-        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Safari/605.1.15',
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36'
-    ]
-    return random.choice(user_agents)
-
-def make_request(url: str, max_retries: int = 3) -> requests.Response:
-    """Make a request with retries and random delays."""
-    for attempt in range(max_retries):
-        try:
-            headers = {
-                'User-Agent': get_random_user_agent(),
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                'Accept-Language': 'az-AZ,az;q=0.9,en-US;q=0.8,en;q=0.7',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1',
-                'Cache-Control': 'no-cache'
-            }
-            
-            # Добавляем случайную задержку между попытками
-            if attempt > 0:
-                delay = random.uniform(2, 5)
-                print(f"Попытка {attempt + 1} после задержки {delay:.1f} сек")
-                time.sleep(delay)
-            
-            response = requests.get(url, headers=headers, timeout=10)
-            response.raise_for_status()
-            return response
-            
-        except requests.exceptions.RequestException as e:
-            if attempt == max_retries - 1:  # Последняя попытка
-                raise
-            print(f"Попытка {attempt + 1} не удалась: {str(e)}")
-            continue
+    def __init__(self, container_classes: set, link_class: str, limit: int = LISTING_LIMIT,
+                 seen: frozenset = None, root: str = ''):
+        super().__init__(convert_charrefs=False)
+        self.container_classes = container_classes
+        self.link_class = link_class
+        self.limit = limit
+        self.seen = seen
+        self.root = root
+        self.count = 0
+        self.done = False
+        self._pinned = False  # текущий блок - закрепленное объявление
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        
+    def feed_bytes(self, chunk: bytes) -> bool:
+        """Скармливает очередной кусок ответа; True - дальше читать не нужно"""
+        if not self.done:
+            self.feed(self._decoder.decode(chunk))
+        return self.done
+        
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        attrs = dict(attrs)
+        classes = set((attrs.get('class') or '').split())
+        if tag == 'div' and classes & self.container_classes:
+            self.count += 1
+            self._pinned = bool(classes & PINNED_CLASSES)
+            # Начался блок сверх лимита - все предыдущие уже прочитаны целиком
+            if self.limit is not None and self.count > self.limit:
+                self.done = True
+        elif tag == 'a' and self.seen and not self._pinned and self.link_class in classes:
+            if listing_key(attrs.get('href') or '', self.root) in self.seen:
+                self.done = True
+
+def listing_scanner(url: str, seen: frozenset = None, limit: int = LISTING_LIMIT):
+    """Фабрика сканеров для потоковой загрузки страницы поиска (limit=None - читать до уже виденного)"""
+    container_classes, link_class = TAP_AZ_SCAN if 'tap.az' in url else BINA_AZ_SCAN
+    return lambda: ListingScanner(container_classes, link_class, limit, seen, site_root(url))
+
+def make_request(url: str, max_retries: int = 3, extra_headers: dict = None, seen: frozenset = None,
+                 limit: int = LISTING_LIMIT) -> requests.Response:
+    """Make a request with retries and random delays (через общий пул соединений).
+    Тело читается потоково и загрузка обрывается после первых limit объявлений (или на seen)."""
+    return engine.fetch_sync(url, max_retries=max_retries, extra_headers=extra_headers,
+                             scanner_factory=listing_scanner(url, seen, limit))
+
+def conditional_headers(url: str) -> dict:
+    """Заголовки условного запроса по сохраненным валидаторам страницы"""
+    with _validators_lock:
+        validators = _validators.get(url)
+    if not validators:
+        return {}
+        
+    headers = {'Cache-Control': 'max-age=0'}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+def remember_validators(url: str, response: requests.Response) -> None:
+    """Запоминает ETag / Last-Modified страницы для следующей проверки"""
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    with _validators_lock:
+        if etag or last_modified:
+            _validators[url] = {'etag': etag, 'last_modified': last_modified}
+        else:
+            _validators.pop(url, None)
+
+def fetch_page(url: str, conditional: bool = False, seen: frozenset = None, limit: int = LISTING_LIMIT):
+    """Загружает страницу. При conditional=True отправляет условный запрос
+    и возвращает None, если страница не изменилась (304). Валидаторы запоминает только
+    автопроверка: после /t по тому же URL она иначе получила бы 304 и пропустила новые объявления."""
+    response = make_request(url, extra_headers=conditional_headers(url) if conditional else None,
+                            seen=seen, limit=limit)
+    if response.status_code == 304:
+        return None
+    if conditional:
+        remember_validators(url, response)
+    return response
 
 def parse_tap_az(url: str, user_filters: dict = None) -> list:
-    """Parse tap.az website and return formatted results and photo URLs"""
+    """Parse tap.az website and return listings (Listing)"""
     try:
         response = make_request(url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        results = []
-        items = soup.find_all('div', class_='products-i')
-        
-        print(f"Найдено объявлений tap.az: {len(items)}")
-        
-        for item in items[:10]:  # Проверяем первые 10 объявлений
-            try:
-                # Проверяем наличие необходимых элементов
-                title_elem = item.find('div', class_='products-name')
-                if not title_elem:
-                    continue
-                    
-                title_text = title_elem.text.strip().lower()
-                
-                # Получаем ссылку
-                link = item.find('a', class_='products-link')
-                if not link:
-                    continue
-                    
-                href = link.get('href', '')
-                if not href.startswith('http'):
-                    href = 'https://tap.az' + href
-                
-                print(f"\nОбработка объявления tap.az: {title_text}")
-                print(f"Ссылка: {href}")
-                
-                # Проверяем фильтры
-                if user_filters:
-                    # Проверяем фильтры по заголовку
-                    if any(filter_text.lower() in title_text for filter_text in user_filters['title']):
-                        print(f"Пропущено по фильтру заголовка: {title_text}")
-                        continue
-                    
-                    # Проверяем фильтры по местоположению
-                    location_elem = item.find('div', class_='products-location')
-                    if location_elem:
-                        location = location_elem.text.strip().lower()
-                        if any(filter_text.lower() in location for filter_text in user_filters['location']):
-                            print(f"Пропущено по фильтру местоположения: {location}")
-                            continue
-                
-                # Получаем цену
-                price_elem = item.find('div', class_='products-price')
-                price = price_elem.text.strip() if price_elem else 'Цена не указана'
-                
-                # Получаем фото
-                photo_elem = item.find('img')
-                photo_url = None
-                if photo_elem:
-                    photo_url = photo_elem.get('data-src') or photo_elem.get('src')
-                    if photo_url and not photo_url.startswith('http'):
-                        photo_url = 'https:' + photo_url
-                
-                # Ищем местоположение
-                location_elem = item.find('div', class_='products-created')
-                location_text = location_elem.text.strip() if location_elem else 'Местоположение не указано'
-                
-                # Проверяем фильтры по местоположению
-                if user_filters and any(f in location_text.lower() for f in user_filters['location']):
-                    continue
-                
-                # Формируем сообщение
-                message = f"🏠 {title_text}\n"
-                message += f"📍 {location_text}\n"
-                message += f"💰 {price}\n"
-                message += f"🔗 {href}"
-                
-                results.append({
-                    'message': message,
-                    'photo_url': photo_url,
-                    'link': href  # Добавляем ссылку для проверки дубликатов
-                })
-                
-            except Exception as e:
-                print(f"Ошибка при обработке объявления tap.az: {str(e)}")
-                continue
-                
+    except requests.RequestException as e:
+        raise Exception(f"Ошибка при запросе к сайту: {str(e)}")
+    return extract_tap_az(response, user_filters)
+
+def extract_tap_az(response: requests.Response, user_filters: dict = None, seen: frozenset = None) -> list:
+    """Извлекает объявления из загруженной страницы tap.az"""
+    try:
+        results = extract_listings('tap_az', response, user_filters, seen)
         print(f"Успешно обработано объявлений tap.az: {len(results)}")
         return results
         
-    except requests.RequestException as e:
-        raise Exception(f"Ошибка при запросе к сайту: {str(e)}")
     except Exception as e:
         raise Exception(f"Ошибка при парсинге: {str(e)}")
 
-def parse_bina_az(url: str, user_filters: dict = None) -> list:
-    """Parse bina.az website and return formatted results and photo URLs"""
-    try:
-        response = make_request(url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        results = []
-        
-        # Ищем все объявления
-        items = soup.find_all('div', class_='items-i') or soup.find_all('div', class_='items') or soup.find_all('div', class_='items-i-vip')
-        
-        print(f"Найдено объявлений: {len(items)}")
-        
-        for item in items[:10]:  # Проверяем первые 10 объявлений
-            try:
-                # Получаем фото и заголовок из атрибута alt
-                photo_elem = item.find('img')
-                if not photo_elem:
-                    print("Не найдено изображение")
-                    continue
-                    
-                full_title = photo_elem.get('alt', '').strip()
-                if not full_title:
-                    print("Не найден заголовок в атрибуте alt")
-                    continue
-                    
-                print(f"\nОбработка объявления: {full_title}")
-                
-                # Извлекаем местоположение из заголовка и формируем чистый заголовок
-                location = "Местоположение не указано"
-                title = full_title
-                if " - " in full_title:
-                    parts = full_title.split(" - ")
-                    if len(parts) >= 2:
-                        # Берем местоположение и делаем первую букву заглавной
-                        location = parts[1].strip()
-                        location = location[0].upper() + location[1:] if location else location
-                        # Формируем заголовок без местоположения
-                        title = parts[0].strip()
-                        if len(parts) > 2:
-                            title += " - " + parts[2].strip()
+def iter_tap_az(soup, user_filters: dict = None, seen: frozenset = None, limit: int = LISTING_LIMIT):
+    """Лениво выдает объявления tap.az сверху вниз и останавливается на первом
+    уже виденном объявлении (seen - ключи объявлений прошлых проверок, см. listing_key)"""
+    items = soup.find_all('div', class_='products-i')
+    # Фильтры собираются один раз на страницу
+    matcher = FilterMatcher(user_filters) if user_filters else None
+    
+    print(f"Найдено объявлений tap.az: {len(items)}")
+    
+    for item in items[:limit]:  # Проверяем первые 10 объявлений
+        try:
+            # Проверяем наличие необходимых элементов
+            title_elem = item.find('div', class_='products-name')
+            if not title_elem:
+                continue
                 
-                # Проверяем фильтры
-                if user_filters:
-                    # Проверяем фильтры по заголовку
-                    if any(filter_text.lower() in full_title.lower() for filter_text in user_filters['title']):
-                        print(f"Пропущено по фильтру заголовка: {full_title}")
-                        continue
-                    
-                    # Проверяем фильтры по местоположению
-                    if any(filter_text.lower() in location.lower() for filter_text in user_filters['location']):
-                        print(f"Пропущено по фильтру местоположения: {location}")
-                        continue
+            title_text = title_elem.text.strip().lower()
+            
+            # Получаем ссылку
+            link = item.find('a', class_='products-link')
+            if not link:
+                continue
                 
-                # Получаем ссылку
-                link = item.find('a', class_='item_link')
-                if not link:
-                    print("Не найдена ссылка на объявление")
+            href = link.get('href', '')
+            if not href.startswith('http'):
+                href = 'https://tap.az' + href
+            
+            # Дальше идут объявления, которые мы уже видели
+            pinned = is_pinned(item)
+            if seen and not pinned and listing_key(href, 'https://tap.az') in seen:
+                print(f"Достигнуто последнее просмотренное объявление tap.az: {href}")
+                return
+            
+            print(f"\nОбработка объявления tap.az: {title_text}")
+            print(f"Ссылка: {href}")
+            
+            # Проверяем фильтры
+            if matcher:
+                # Проверяем фильтры по заголовку
+                if matcher.title_blocked(title_text):
+                    print(f"Пропущено по фильтру заголовка: {title_text}")
                     continue
-                    
-                href = link.get('href', '')
-                if not href.startswith('http'):
-                    href = 'https://bina.az' + href
                 
-                # Получаем цену
-                price_elem = item.find('div', class_='items-price') or item.find('div', class_='price') or item.find('div', class_='items-price-vip')
-                price = price_elem.text.strip() if price_elem else 'Цена не указана'
-                
-                # Получаем URL фото
+                # Проверяем фильтры по местоположению
+                location_elem = item.find('div', class_='products-location')
+                if location_elem:
+                    location = location_elem.text.strip().lower()
+                    if matcher.location_blocked(location):
+                        print(f"Пропущено по фильтру местоположения: {location}")
+                        continue
+            
+            # Получаем цену
+            price_elem = item.find('div', class_='products-price')
+            price = price_elem.text.strip() if price_elem else 'Цена не указана'
+            
+            # Получаем фото
+            photo_elem = item.find('img')
+            photo_url = None
+            if photo_elem:
                 photo_url = photo_elem.get('data-src') or photo_elem.get('src')
                 if photo_url and not photo_url.startswith('http'):
                     photo_url = 'https:' + photo_url
-                
-                # Формируем сообщение
-                message = f"🏠 {title}\n"
-                message += f"📍 {location}\n"
-                message += f"💰 {price}\n"
-                message += f"🔗 {href}"
-                
-                results.append({
-                    'message': message,
-                    'photo_url': photo_url,
-                    'link': href  # Добавляем ссылку для проверки дубликатов
-                })
-                
-            except Exception as e:
-                print(f"Ошибка при обработке объявления bina.az: {str(e)}")
+            
+            # Район (используется только для фильтров)
+            region_elem = item.find('div', class_='products-location')
+            region_text = region_elem.text.strip() if region_elem else ''
+            
+            # Ищем местоположение
+            location_elem = item.find('div', class_='products-created')
+            location_text = location_elem.text.strip() if location_elem else 'Местоположение не указано'
+            
+            # Проверяем фильтры по местоположению
+            if matcher and matcher.location_blocked(location_text.lower()):
                 continue
-                
+            
+            # Сообщение сформируется при первой отправке (Listing.render)
+            yield Listing('tap_az', title_text, location_text, price, photo_url, href,
+                          region=region_text, pinned=pinned)
+            
+        except Exception as e:
+            print(f"Ошибка при обработке объявления tap.az: {str(e)}")
+            continue
+
+def parse_bina_az(url: str, user_filters: dict = None) -> list:
+    """Parse bina.az website and return listings (Listing)"""
+    try:
+        response = make_request(url)
+    except requests.RequestException as e:
+        raise Exception(f"Ошибка при запросе к сайту: {str(e)}")
+    return extract_bina_az(response, user_filters)
+
+def extract_bina_az(response: requests.Response, user_filters: dict = None, seen: frozenset = None) -> list:
+    """Извлекает объявления из загруженной страницы bina.az"""
+    try:
+        results = extract_listings('bina_az', response, user_filters, seen)
         print(f"Успешно обработано объявлений: {len(results)}")
         return results
         
-    except requests.RequestException as e:
-        raise Exception(f"Ошибка при запросе к сайту: {str(e)}")
     except Exception as e:
         raise Exception(f"Ошибка при парсинге: {str(e)}")
 
-def parse_website(url: str, user_filters: dict = None) -> list:
-    """Parse website and return results."""
+def iter_bina_az(soup, user_filters: dict = None, seen: frozenset = None, limit: int = LISTING_LIMIT):
+    """Лениво выдает объявления bina.az сверху вниз и останавливается на первом
+    уже виденном объявлении (seen - ключи объявлений прошлых проверок, см. listing_key)"""
+    # Ищем все объявления
+    items = soup.find_all('div', class_='items-i') or soup.find_all('div', class_='items') or soup.find_all('div', class_='items-i-vip')
+    # Фильтры собираются один раз на страницу
+    matcher = FilterMatcher(user_filters) if user_filters else None
+    
+    print(f"Найдено объявлений: {len(items)}")
+    
+    for item in items[:limit]:  # Проверяем первые 10 объявлений
+        try:
+            # Получаем ссылку
+            link = item.find('a', class_='item_link')
+            if not link:
+                print("Не найдена ссылка на объявление")
+                continue
+                
+            href = link.get('href', '')
+            if not href.startswith('http'):
+                href = 'https://bina.az' + href
+            
+            # Дальше идут объявления, которые мы уже видели
+            pinned = is_pinned(item)
+            if seen and not pinned and listing_key(href, 'https://bina.az') in seen:
+                print(f"Достигнуто последнее просмотренное объявление bina.az: {href}")
+                return
+            
+
+            # Получаем фото и заголовок из атрибута alt
+            photo_elem = item.find('img')
+            if not photo_elem:
+                print("Не найдено изображение")
+                continue
+                
+            full_title = photo_elem.get('alt', '').strip()
+            if not full_title:
+                print("Не найден заголовок в атрибуте alt")
+                continue
+                
+            print(f"\nОбработка объявления: {full_title}")
+            
+            # Извлекаем местоположение из заголовка и формируем чистый заголовок
+            location = "Местоположение не указано"
+            title = full_title
+            if " - " in full_title:
+                parts = full_title.split(" - ")
+                if len(parts) >= 2:
+                    # Берем местоположение и делаем первую букву заглавной
+                    location = parts[1].strip()
+                    location = location[0].upper() + location[1:] if location else location
+                    # Формируем заголовок без местоположения
+                    title = parts[0].strip()
+                    if len(parts) > 2:
+                        title += " - " + parts[2].strip()
+            
+            # Проверяем фильтры
+            if matcher:
+                # Проверяем фильтры по заголовку
+                if matcher.title_blocked(full_title.lower()):
+                    print(f"Пропущено по фильтру заголовка: {full_title}")
+                    continue
+                
+                # Проверяем фильтры по местоположению
+                if matcher.location_blocked(location.lower()):
+                    print(f"Пропущено по фильтру местоположения: {location}")
+                    continue
+            
+            # Получаем цену
+            price_elem = item.find('div', class_='items-price') or item.find('div', class_='price') or item.find('div', class_='items-price-vip')
+            price = price_elem.text.strip() if price_elem else 'Цена не указана'
+            
+            # Получаем URL фото
+            photo_url = photo_elem.get('data-src') or photo_elem.get('src')
+            if photo_url and not photo_url.startswith('http'):
+                photo_url = 'https:' + photo_url
+            
+            # Сообщение сформируется при первой отправке (Listing.render)
+            yield Listing('bina_az', title, location, price, photo_url, href, pinned=pinned)
+            
+        except Exception as e:
+            print(f"Ошибка при обработке объявления bina.az: {str(e)}")
+            continue
+
+# Контейнеры и функция разбора для каждого сайта
+SITE_PARSERS = {
+    'tap_az': (TAP_AZ_CONTAINERS, iter_tap_az),
+    'bina_az': (BINA_AZ_CONTAINERS, iter_bina_az)
+}
+
+def set_parse_processes(processes: int) -> int:
+    """Включает разбор страниц в пуле из processes процессов (0 - в текущем потоке).
+    Процессы создаются сразу: вызывать до запуска остальных потоков бота.
+    Возвращает число процессов (0 - если пул на этой системе недоступен)."""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=True)
+        _process_pool = None
+    if processes > 0 and 'fork' not in multiprocessing.get_all_start_methods():
+        # Без fork (Windows) дочерние процессы заново выполняли бы bot.py со всеми его потоками
+        print("Пул процессов для разбора недоступен на этой системе, разбор идет в потоках проверки")
+        return 0
+    if processes > 0:
+        # fork: дочерним процессам не нужно заново импортировать bot.py
+        _process_pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork'))
+        for future in [_process_pool.submit(abs, 0) for _ in range(processes)]:
+            future.result()
+        print(f"Разбор страниц в пуле процессов: {processes}")
+    return processes
+
+def extract_rows(site: str, content: bytes, encoding: str, backend: str, partial: bool,
+                 user_filters: dict = None, seen: frozenset = None, limit: int = LISTING_LIMIT) -> list:
+    """Разбор в процессе пула: сырые байты страницы -> кортежи объявлений (Listing.row)"""
+    containers, iterate = SITE_PARSERS[site]
+    soup = parse_html(content, encoding, backend, only=containers, partial=partial)
+    return [listing.row() for listing in iterate(soup, user_filters, seen, limit)]
+
+def extract_listings(site: str, response: requests.Response, user_filters: dict = None, seen: frozenset = None,
+                     limit: int = LISTING_LIMIT) -> list:
+    """Разбирает страницу сайта в пуле процессов (если включен) или здесь же"""
+    encoding = page_encoding(response.headers)
+    if _process_pool is not None:
+        rows = _process_pool.submit(
+            extract_rows, site, response.content, encoding, get_backend(), is_partial(), user_filters, seen, limit
+        ).result()
+        return [Listing.from_row(row) for row in rows]
+        
+    containers, iterate = SITE_PARSERS[site]
+    soup = parse_html(response.content, encoding, only=containers)
+    return list(iterate(soup, user_filters, seen, limit))
+
+def get_extractor(url: str):
+    """Возвращает функцию разбора страницы для сайта"""
     if 'tap.az' in url:
-        return parse_tap_az(url, user_filters)
+        return extract_tap_az
     elif 'bina.az' in url:
-        return parse_bina_az(url, user_filters)
+        return extract_bina_az
     else:
-        raise ValueError('Неподдерживаемый сайт') 
\ No newline at end of file
+        raise ValueError('Неподдерживаемый сайт')
+
+def parse_website(url: str, user_filters: dict = None, conditional: bool = False, seen: frozenset = None) -> list:
+    """Parse website and return results.
+    При conditional=True неизменившаяся страница (304) не скачивается и дает пустой список;
+    seen - ключи объявлений прошлых проверок, разбор останавливается на первом из них."""
+    extractor = get_extractor(url)
+    try:
+        response = fetch_page(url, conditional, seen)
+    except requests.RequestException as e:
+        raise Exception(f"Ошибка при запросе к сайту: {str(e)}")
+        
+    if response is None:
+        print(f"Страница не изменилась: {url}")
+        return []
+    return extractor(response, user_filters, seen)
+
+def page_url(url: str, page: int) -> str:
+    """URL N-й страницы результатов поиска (параметр page)"""
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if key != 'page']
+    if page > 1:
+        query.append(('page', str(page)))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))
+
+def reached_seen(url: str, response: requests.Response, seen: frozenset) -> bool:
+    """Есть ли на загруженной странице (не закрепленное) объявление, виденное прошлыми проверками"""
+    scanner = listing_scanner(url, seen, limit=None)()
+    return scanner.feed_bytes(response.content)
+
+def crawl_website(url: str, conditional: bool = False, seen: frozenset = None, max_pages: int = 1) -> list:
+    """Проверка сохраненного поиска с досылкой пропущенного: если на первой странице нет
+    ни одного объявления, виденного прошлыми проверками (новых объявлений больше страницы -
+    например, после простоя), следующие страницы до max_pages загружаются одновременно
+    и объявления собираются до первой страницы с виденным. Без seen (первая проверка) -
+    как parse_website."""
+    if not seen or max_pages <= 1:
+        return parse_website(url, conditional=conditional, seen=seen)
+        
+    site = 'tap_az' if 'tap.az' in url else 'bina_az'
+    try:
+        response = fetch_page(url, conditional, seen, limit=None)
+    except requests.RequestException as e:
+        raise Exception(f"Ошибка при запросе к сайту: {str(e)}")
+    if response is None:
+        print(f"Страница не изменилась: {url}")
+        return []
+        
+    results = extract_listings(site, response, seen=seen, limit=None)
+    if reached_seen(url, response, seen) or not results:
+        return results
+        
+    # Все следующие страницы - одним параллельным заходом (в пределах бюджета хоста)
+    urls = [page_url(url, page) for page in range(2, max_pages + 1)]
+    print(f"Виденных объявлений нет на первой странице, загружаем еще {len(urls)}: {url}")
+    responses = engine.fetch_all_sync(
+        urls, scanner_factories=[listing_scanner(page, seen, limit=None) for page in urls]
+    )
+    
+    root = site_root(url)
+    collected = {listing_key(listing.link, root) for listing in results}
+    for page, response in zip(urls, responses):
+        if isinstance(response, Exception):
+            print(f"Ошибка при загрузке страницы {page}: {str(response)}")
+            break
+        page_results = extract_listings(site, response, seen=seen, limit=None)
+        # Объявления сдвигаются между страницами, пока мы их загружаем - убираем повторы
+        for listing in page_results:
+            key = listing_key(listing.link, root)
+            if key not in collected:
+                collected.add(key)
+                results.append(listing)
+        if reached_seen(page, response, seen) or not page_results:
+            break
+    else:
+        print(f"Виденных объявлений нет и на {max_pages} страницах: {url}")
+    return results
+
+def seen_keys(listings: List[Listing], unsent=()) -> tuple:
+    """Ключи найденных объявлений (кроме закрепленных) сверху вниз - для следующих проверок.
+    unsent - объявления, которые не удалось отправить: запоминаются только объявления ниже
+    последнего из них, иначе следующая проверка остановится выше и не отправит их снова"""
+    for i in range(len(listings) - 1, -1, -1):
+        if listings[i] in unsent and not listings[i].pinned:
+            listings = listings[i + 1:]
+            break
+    return tuple(
+        listing_key(listing.link, site_root(listing.link))
+        for listing in listings if listing.link and not listing.pinned
+    )
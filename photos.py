@@ -0,0 +1,213 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import List, Optional
+from storage import DB_FILE, SqliteBacked
+from fetcher import engine as fetch_engine
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Размер, до которого уменьшаются фото: Telegram все равно показывает не больше 1280 px
+PHOTO_MAX_SIDE = 1280
+PHOTO_JPEG_QUALITY = 85
+# Максимальный размер скачиваемого фото (байт)
+PHOTO_MAX_BYTES = 10 * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS photo_file_ids (
+    photo_url TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS photo_file_ids_last_used ON photo_file_ids (last_used);
+CREATE TABLE IF NOT EXISTS photo_cache (
+    photo_url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS photo_cache_digest ON photo_cache (digest);
+"""
+
+class PhotoRegistry(SqliteBacked):
+    """Постоянное соответствие URL фото -> file_id Telegram. После первой загрузки
+    фото повторно отправляется по file_id в любой чат, без скачивания и загрузки."""
+
+    schema = SCHEMA
+
+    def __init__(self, path: str = DB_FILE, capacity: int = 10000, memory_capacity: int = 1000):
+        super().__init__(path)
+        self.capacity = capacity
+        self.memory_capacity = memory_capacity
+        self._memory = OrderedDict()  # горячая часть в памяти (LRU)
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _remember(self, photo_url: str, file_id: str) -> None:
+        with self._lock:
+            self._memory[photo_url] = file_id
+            self._memory.move_to_end(photo_url)
+            while len(self._memory) > self.memory_capacity:
+                self._memory.popitem(last=False)
+
+    def get(self, photo_url: str) -> Optional[str]:
+        """file_id ранее загруженного фото или None"""
+        with self._lock:
+            file_id = self._memory.get(photo_url)
+            if file_id is not None:
+                self._memory.move_to_end(photo_url)
+                return file_id
+
+        with self._connection() as conn:
+            row = conn.execute('SELECT file_id FROM photo_file_ids WHERE photo_url = ?', (photo_url,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE photo_file_ids SET last_used = ? WHERE photo_url = ?', (time.time(), photo_url))
+        self._remember(photo_url, row[0])
+        return row[0]
+
+    def put(self, photo_url: str, file_id: str) -> None:
+        """Запоминает file_id загруженного фото; самые давние записи вытесняются"""
+        self._remember(photo_url, file_id)
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO photo_file_ids (photo_url, file_id, last_used) VALUES (?, ?, ?)',
+                (photo_url, file_id, time.time())
+            )
+            self._writes += 1
+            # Чистим не на каждой записи, а примерно раз в сотню
+            if self._writes % 100 == 0:
+                conn.execute(
+                    'DELETE FROM photo_file_ids WHERE photo_url IN ('
+                    'SELECT photo_url FROM photo_file_ids ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                    (self.capacity,)
+                )
+
+    def forget(self, photo_url: str) -> None:
+        """Удаляет file_id, который Telegram больше не принимает"""
+        with self._lock:
+            self._memory.pop(photo_url, None)
+        with self._connection() as conn:
+            conn.execute('DELETE FROM photo_file_ids WHERE photo_url = ?', (photo_url,))
+
+def prepare_photo(raw: bytes) -> bytes:
+    """Уменьшает и пережимает фото под размер показа в Telegram (без Pillow - как есть)"""
+    if Image is None:
+        return raw
+    try:
+        with Image.open(BytesIO(raw)) as image:
+            image = image.convert('RGB')
+            image.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+            output = BytesIO()
+            image.save(output, format='JPEG', quality=PHOTO_JPEG_QUALITY, optimize=True)
+    except Exception as e:
+        print(f"Не удалось обработать фото, отправляем оригинал: {str(e)}")
+        return raw
+    processed = output.getvalue()
+    return processed if len(processed) < len(raw) else raw
+
+class PhotoCache(SqliteBacked):
+    """Кэш фото объявлений на диске. Файлы называются по sha256 содержимого (одинаковые
+    фото по разным URL хранятся один раз), URL -> хэш хранится в базе. Размер кэша
+    ограничен, первыми удаляются давно использованные файлы вместе с их записями."""
+
+    schema = SCHEMA
+
+    def __init__(self, directory: str = 'photo_cache', max_bytes: int = 200 * 1024 * 1024,
+                 workers: int = 2, path: str = DB_FILE):
+        super().__init__(path)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # Скачивание и уменьшение фото идут в отдельном пуле, несколько фото одновременно
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='photo')
+        self._evict_lock = threading.Lock()
+        self._size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+    def _file(self, digest: str) -> str:
+        return os.path.join(self.directory, digest + '.jpg')
+
+    def load(self, photo_url: str) -> Optional[bytes]:
+        """Готовое к отправке фото из кэша или None (только чтение с диска, без сети)"""
+        conn = self._connection()
+        row = conn.execute('SELECT digest FROM photo_cache WHERE photo_url = ?', (photo_url,)).fetchone()
+        if row is None:
+            return None
+        path = self._file(row[0])
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # отметка для вытеснения давно использованных
+            return data
+        except FileNotFoundError:
+            with conn:
+                conn.execute('DELETE FROM photo_cache WHERE photo_url = ?', (photo_url,))
+            return None
+
+    def _store(self, photo_url: str) -> None:
+        """Скачивает, уменьшает и сохраняет фото (выполняется в пуле)"""
+        raw = fetch_engine.fetch_sync(photo_url, max_bytes=PHOTO_MAX_BYTES).content
+        digest = hashlib.sha256(raw).hexdigest()
+        path = self._file(digest)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            data = prepare_photo(raw)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            with self._evict_lock:
+                self._size += len(data)
+            print(f"Фото сохранено в кэш: {len(raw)} -> {len(data)} байт")
+
+        with self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO photo_cache (photo_url, digest) VALUES (?, ?)', (photo_url, digest))
+        self._evict()
+
+    def prefetch(self, photo_urls: List[str]) -> None:
+        """Заранее скачивает и уменьшает фото, которых еще нет в кэше, - параллельно в пуле.
+        Вызывается до постановки сообщений в очередь, чтобы отправка только читала файлы."""
+        missing = [url for url in dict.fromkeys(photo_urls) if url and self.load(url) is None]
+        futures = [self._pool.submit(self._store, url) for url in missing]
+        for url, future in zip(missing, futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Ошибка при загрузке фото {url}: {str(e)}")
+
+    def _evict(self) -> None:
+        """Удаляет самые давно использованные файлы, пока кэш больше лимита"""
+        with self._evict_lock:
+            if self._size <= self.max_bytes:
+                return
+            entries = sorted(
+                (entry for entry in os.scandir(self.directory) if entry.is_file() and entry.name.endswith('.jpg')),
+                key=lambda entry: entry.stat().st_mtime
+            )
+            # Освобождаем с запасом, чтобы не чистить на каждом новом фото
+            target = self.max_bytes * 0.9
+            removed = []
+            for entry in entries:
+                if self._size <= target:
+                    break
+                size = entry.stat().st_size
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                self._size -= size
+                removed.append(entry.name[:-len('.jpg')])
+                
+        # Записи об удаленных файлах больше не нужны
+        if removed:
+            with self._connection() as conn:
+                conn.executemany('DELETE FROM photo_cache WHERE digest = ?', [(digest,) for digest in removed])
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,330 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+from history import SentHistory, ad_key
+
+# Файл базы данных пользователей
+DB_FILE = 'users.db'
+# Старый файл с данными пользователей (переносится в базу один раз)
+LEGACY_USERS_FILE = 'users.json'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    active_chat_id INTEGER,
+    auto_enabled INTEGER NOT NULL DEFAULT 0,
+    auto_interval INTEGER NOT NULL DEFAULT 300,
+    auto_chat_id INTEGER,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS user_urls (
+    user_id INTEGER NOT NULL,
+    site TEXT NOT NULL,
+    url TEXT NOT NULL,
+    PRIMARY KEY (user_id, site)
+);
+CREATE TABLE IF NOT EXISTS user_filters (
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (user_id, kind, position)
+);
+CREATE TABLE IF NOT EXISTS sent_history (
+    user_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    ad_key INTEGER NOT NULL,
+    PRIMARY KEY (user_id, seq)
+);
+CREATE TABLE IF NOT EXISTS schedule (
+    key TEXT PRIMARY KEY,
+    next_run REAL NOT NULL,
+    watermark TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Ключи данных пользователя, у которых есть свои столбцы / таблицы
+KNOWN_KEYS = {'urls', 'filters', 'sent_ads', 'active_chat_id', 'auto_check'}
+
+class UserStore:
+    """Хранилище пользователей в SQLite (режим WAL): отдельные строки для URL,
+    фильтров, настроек автопроверки и истории отправленных объявлений"""
+
+    def __init__(self, path: str = DB_FILE):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+        self._migrate_sent_ads()
+        self._migrate_schedule()
+
+    def _migrate_sent_ads(self) -> None:
+        """Переводит старую таблицу sent_ads (ссылки) в sent_history (числовые ключи)"""
+        conn = self._connection()
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sent_ads'").fetchone():
+            return
+        links = {}
+        for user_id, ad in conn.execute('SELECT user_id, ad FROM sent_ads ORDER BY user_id, seq'):
+            links.setdefault(user_id, []).append(ad)
+        with conn:
+            for user_id, user_links in links.items():
+                self._save_history(conn, user_id, SentHistory.from_links(user_links))
+            conn.execute('DROP TABLE sent_ads')
+        print(f"История отправленных объявлений переведена на числовые ключи: {len(links)} пользователей")
+
+    def _migrate_schedule(self) -> None:
+        """Добавляет в расписание столбец виденных объявлений (базы, созданные без него)"""
+        conn = self._connection()
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(schedule)')}
+        if 'watermark' not in columns:
+            with conn:
+                conn.execute('ALTER TABLE schedule ADD COLUMN watermark TEXT')
+
+    def _connection(self) -> sqlite3.Connection:
+        """Свое соединение для каждого потока (JobQueue, обработчики команд)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, cached_statements=256)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = conn
+        return conn
+
+    def load_user(self, user_id: int) -> Optional[dict]:
+        """Загружает данные пользователя в прежнем формате словаря или None"""
+        conn = self._connection()
+        row = conn.execute(
+            'SELECT active_chat_id, auto_enabled, auto_interval, auto_chat_id, extra FROM users WHERE user_id = ?',
+            (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        active_chat_id, auto_enabled, auto_interval, auto_chat_id, extra = row
+        data = json.loads(extra)
+        data['urls'] = dict(conn.execute('SELECT site, url FROM user_urls WHERE user_id = ?', (user_id,)))
+        data['filters'] = {'title': [], 'location': []}
+        for kind, text in conn.execute(
+            'SELECT kind, text FROM user_filters WHERE user_id = ? ORDER BY kind, position', (user_id,)
+        ):
+            data['filters'].setdefault(kind, []).append(text)
+        data['sent_ads'] = SentHistory.from_rows(conn.execute(
+            'SELECT seq, ad_key FROM sent_history WHERE user_id = ? ORDER BY seq', (user_id,)
+        ))
+        if active_chat_id is not None:
+            data['active_chat_id'] = active_chat_id
+        data['auto_check'] = {'enabled': bool(auto_enabled), 'interval': auto_interval}
+        if auto_chat_id is not None:
+            data['auto_check']['active_chat_id'] = auto_chat_id
+        return data
+
+    def save_user(self, user_id: int, data: dict) -> None:
+        """Сохраняет данные одного пользователя одной транзакцией"""
+        self.save_users({user_id: data})
+
+    def save_users(self, users: dict) -> None:
+        """Сохраняет нескольких пользователей одной транзакцией"""
+        saved = []
+        with self._connection() as conn:
+            for user_id, data in users.items():
+                saved.append(self._save_user(conn, user_id, data))
+        # История считается сохраненной только после успешного коммита
+        for history, seq in saved:
+            history.mark_saved(seq)
+
+    def _save_history(self, conn: sqlite3.Connection, user_id: int, history: SentHistory) -> int:
+        """Дописывает новые ключи истории и удаляет вытесненные; возвращает сохраненный номер"""
+        rows, first_seq, saved_seq = history.unsaved_rows()
+        conn.executemany(
+            'INSERT OR REPLACE INTO sent_history (user_id, seq, ad_key) VALUES (?, ?, ?)',
+            [(user_id, seq, key) for seq, key in rows]
+        )
+        conn.execute('DELETE FROM sent_history WHERE user_id = ? AND seq < ?', (user_id, first_seq))
+        return saved_seq
+
+    def _save_user(self, conn: sqlite3.Connection, user_id: int, data: dict) -> Tuple[SentHistory, int]:
+        auto_check = data.get('auto_check', {})
+        extra = {key: value for key, value in data.items() if key not in KNOWN_KEYS}
+        conn.execute(
+            'INSERT INTO users (user_id, active_chat_id, auto_enabled, auto_interval, auto_chat_id, extra) '
+            'VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET active_chat_id = excluded.active_chat_id, '
+            'auto_enabled = excluded.auto_enabled, auto_interval = excluded.auto_interval, '
+            'auto_chat_id = excluded.auto_chat_id, extra = excluded.extra',
+            (
+                user_id,
+                data.get('active_chat_id'),
+                int(auto_check.get('enabled', False)),
+                auto_check.get('interval', 300),
+                auto_check.get('active_chat_id'),
+                json.dumps(extra, ensure_ascii=False)
+            )
+        )
+
+        conn.execute('DELETE FROM user_urls WHERE user_id = ?', (user_id,))
+        conn.executemany(
+            'INSERT INTO user_urls (user_id, site, url) VALUES (?, ?, ?)',
+            [(user_id, site, url) for site, url in data.get('urls', {}).items()]
+        )
+
+        conn.execute('DELETE FROM user_filters WHERE user_id = ?', (user_id,))
+        conn.executemany(
+            'INSERT INTO user_filters (user_id, kind, position, text) VALUES (?, ?, ?, ?)',
+            [(user_id, kind, position, text)
+             for kind, texts in data.get('filters', {}).items()
+             for position, text in enumerate(texts)]
+        )
+
+        # Старый формат (список ссылок) переводим в историю по числовым ключам
+        history = data.get('sent_ads')
+        if not isinstance(history, SentHistory):
+            history = SentHistory.from_links(history or [])
+            data['sent_ads'] = history
+        return history, self._save_history(conn, user_id, history)
+
+    def auto_check_users(self) -> List[Tuple[int, int, Optional[int]]]:
+        """Пользователи с включенной автопроверкой: (user_id, интервал, чат)"""
+        return list(self._connection().execute(
+            'SELECT user_id, auto_interval, auto_chat_id FROM users WHERE auto_enabled = 1'
+        ))
+
+    def load_schedule(self) -> Dict[str, Tuple[float, tuple]]:
+        """Сохраненные время следующей проверки и ключи виденных объявлений каждого поиска"""
+        schedule = {}
+        for key, next_run, watermark in self._connection().execute('SELECT key, next_run, watermark FROM schedule'):
+            if not watermark:
+                seen = ()
+            elif watermark.startswith('['):
+                seen = tuple(json.loads(watermark))
+            else:
+                # Старый формат - одна ссылка на самое новое объявление
+                seen = (ad_key(watermark.split('?')[0]),)
+            schedule[key] = (next_run, seen)
+        return schedule
+
+    def save_schedule(self, changed: Dict[str, Tuple[float, tuple]], removed: List[str] = ()) -> None:
+        """Сохраняет изменившиеся строки расписания и удаляет строки удаленных поисков одной транзакцией"""
+        if not changed and not removed:
+            return
+        with self._connection() as conn:
+            conn.executemany(
+                'INSERT INTO schedule (key, next_run, watermark) VALUES (?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET next_run = excluded.next_run, watermark = excluded.watermark',
+                [(key, next_run, json.dumps(list(seen))) for key, (next_run, seen) in changed.items()]
+            )
+            conn.executemany('DELETE FROM schedule WHERE key = ?', [(key,) for key in removed])
+
+    def migrate_from_json(self, path: str = LEGACY_USERS_FILE) -> int:
+        """Однократно переносит пользователей из users.json. Возвращает число перенесенных."""
+        conn = self._connection()
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_json'").fetchone():
+            return 0
+
+        users = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                users = {int(user_id): data for user_id, data in json.load(f).items()}
+
+        saved = []
+        with conn:
+            for user_id, data in users.items():
+                saved.append(self._save_user(conn, user_id, data))
+            conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_json', ?)", (path,))
+        for history, seq in saved:
+            history.mark_saved(seq)
+        print(f"Перенесено пользователей из {path} в базу: {len(users)}")
+        return len(users)
+
+class SqliteBacked:
+    """Основа для вспомогательных таблиц (фото, карточки объявлений): своя схема
+    и свое соединение с базой в каждом потоке"""
+
+    schema = ''
+
+    def __init__(self, path: str = DB_FILE):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(self.schema)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+class WriteBehind:
+    """Отложенная запись: измененные пользователи помечаются в памяти и сохраняются
+    пачкой (одной транзакцией) по таймеру или при накоплении порога.
+    mode='sync' - каждое изменение сохраняется сразу (как раньше),
+    mode='batched' - при падении можно потерять последние flush_interval секунд
+    (в худшем случае объявления придут повторно), зато записей на диск намного меньше."""
+
+    def __init__(self, store: UserStore, get_data, mode: str = 'batched',
+                 flush_interval: float = 5.0, flush_threshold: int = 50):
+        self.store = store
+        self.get_data = get_data  # user_id -> текущий словарь данных пользователя
+        self.mode = mode
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def mark_dirty(self, user_id: int) -> None:
+        """Отмечает, что данные пользователя изменились"""
+        with self._lock:
+            self._dirty.add(user_id)
+            pending = len(self._dirty)
+        if self.mode == 'sync' or pending >= self.flush_threshold:
+            self.flush()
+
+    def flush(self) -> int:
+        """Сохраняет всех измененных пользователей одной транзакцией. Возвращает их число."""
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+            if not dirty:
+                return 0
+            try:
+                self.store.save_users({user_id: self.get_data(user_id) for user_id in dirty})
+            except Exception as e:
+                # Не потеряем изменения: попробуем снова при следующем сбросе
+                with self._lock:
+                    self._dirty |= dirty
+                print(f"Ошибка при сохранении данных пользователей: {str(e)}")
+                return 0
+            return len(dirty)
+
+    def start(self) -> None:
+        """Запускает фоновый сброс по таймеру"""
+        if self.mode == 'sync' or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self) -> None:
+        """Останавливает таймер и сохраняет все, что не успело записаться"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        saved = self.flush()
+        if saved:
+            print(f"При остановке сохранены данные пользователей: {saved}")
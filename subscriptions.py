@@ -0,0 +1,182 @@
+import heapq
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from parser import canonical_url, SEEN_KEEP
+
+# Названия сайтов для сообщений пользователю
+SITE_NAMES = {
+    'tap_az': 'Tap.az',
+    'bina_az': 'Bina.az'
+}
+
+class Subscription:
+    """Один уникальный поиск и все пользователи, которые на него подписаны"""
+
+    def __init__(self, key: str, site: str):
+        self.key = key  # канонический URL, он же загружается
+        self.site = site
+        self.subscribers = {}  # user_id -> интервал проверки в секундах
+        self.next_run = 0.0
+        self.seen = ()  # ключи объявлений прошлых проверок, самые новые первыми
+        # Новые подписчики: они еще не получили текущие объявления поиска, поэтому
+        # следующая проверка идет без виденных объявлений и без условного запроса
+        self.fresh = set()
+
+    @property
+    def interval(self) -> int:
+        """Поиск проверяется с интервалом самого нетерпеливого подписчика"""
+        return min(self.subscribers.values())
+
+class SubscriptionRegistry:
+    """Группирует сохраненные поиски пользователей по каноническому URL и планирует
+    их проверки: куча по времени следующего запуска, первый запуск - в случайный
+    момент внутри интервала, чтобы проверки не шли одновременно"""
+
+    def __init__(self, saved: Dict[str, Tuple[float, tuple]] = None):
+        self._lock = threading.Lock()
+        self._subscriptions = {}  # key -> Subscription
+        self._user_keys = {}  # user_id -> множество ключей
+        self._heap = []  # (next_run, key); устаревшие записи пропускаются при извлечении
+        # Сохраненные время запуска и виденные объявления каждого поиска (после перезапуска)
+        self._saved = dict(saved or {})
+        # Что изменилось с прошлого сохранения: ключи измененных и удаленных поисков
+        self._changed = set()
+        self._removed = set()
+
+    def _schedule(self, subscription: Subscription, next_run: float) -> None:
+        subscription.next_run = next_run
+        heapq.heappush(self._heap, (next_run, subscription.key))
+        self._changed.add(subscription.key)
+        self._removed.discard(subscription.key)
+
+    def subscribe(self, user_id: int, site: str, url: str, interval: int, fresh: bool = True) -> str:
+        """Подписывает пользователя на поиск и возвращает ключ подписки. fresh=False - пользователь
+        уже получал объявления поиска (восстановление после перезапуска): проверка продолжает с виденных объявлений."""
+        key = canonical_url(url)
+        now = time.time()
+        with self._lock:
+            subscription = self._subscriptions.get(key)
+            if subscription is None:
+                subscription = Subscription(key, site)
+                self._subscriptions[key] = subscription
+            subscription.subscribers[user_id] = interval
+            if fresh:
+                subscription.fresh.add(user_id)
+            self._user_keys.setdefault(user_id, set()).add(key)
+            
+            jittered = now + random.uniform(0, subscription.interval)
+            if not subscription.next_run:
+                # Новый поиск продолжает сохраненное расписание, если оно еще впереди,
+                # иначе запускается в случайный момент своего интервала
+                saved, subscription.seen = self._saved.pop(key, (0.0, ()))
+                self._schedule(subscription, saved if now <= saved <= now + subscription.interval else jittered)
+            elif subscription.next_run > now + subscription.interval:
+                # Подписчик с меньшим интервалом - не ждем старого запуска
+                self._schedule(subscription, jittered)
+        return key
+
+    def unsubscribe(self, user_id: int) -> List[str]:
+        """Отписывает пользователя от всех поисков; возвращает поиски, у которых не осталось подписчиков"""
+        removed = []
+        with self._lock:
+            for key in self._user_keys.pop(user_id, set()):
+                subscription = self._subscriptions.get(key)
+                if subscription is None:
+                    continue
+                subscription.subscribers.pop(user_id, None)
+                subscription.fresh.discard(user_id)
+                if not subscription.subscribers:
+                    # Запоминаем расписание: при повторной подписке (смена URL) оно сохранится
+                    self._saved[key] = (subscription.next_run, subscription.seen)
+                    del self._subscriptions[key]
+                    self._changed.discard(key)
+                    self._removed.add(key)
+                    removed.append(key)
+        return removed
+
+    def seen(self, key: str) -> frozenset:
+        """Ключи объявлений, найденных прошлыми проверками поиска: проверка останавливается на них"""
+        with self._lock:
+            subscription = self._subscriptions.get(key)
+            return frozenset(subscription.seen) if subscription else frozenset()
+
+    def mark_seen(self, key: str, keys: tuple) -> None:
+        """Добавляет объявления проверки (самые новые первыми) к виденным; помним SEEN_KEEP последних"""
+        with self._lock:
+            subscription = self._subscriptions.get(key)
+            if subscription is not None and keys:
+                subscription.seen = tuple(dict.fromkeys(keys + subscription.seen))[:SEEN_KEEP]
+                self._changed.add(key)
+
+    def seeded(self, key: str, user_ids: List[int]) -> None:
+        """Новые подписчики получили результат проверки: дальше поиск проверяется до виденных объявлений"""
+        with self._lock:
+            subscription = self._subscriptions.get(key)
+            if subscription is not None:
+                subscription.fresh.difference_update(user_ids)
+
+    def _pop_stale(self) -> None:
+        """Убирает с вершины кучи записи удаленных и перепланированных поисков"""
+        while self._heap:
+            next_run, key = self._heap[0]
+            subscription = self._subscriptions.get(key)
+            if subscription is not None and subscription.next_run == next_run:
+                return
+            heapq.heappop(self._heap)
+
+    def due(self, now: float = None, limit: int = None) -> List[Tuple[str, str, List[int], List[int]]]:
+        """Возвращает поиски, которые пора проверить (не больше limit): ключ, сайт, подписчики
+        и новые подписчики, - и планирует их следующий запуск"""
+        now = time.time() if now is None else now
+        result = []
+        with self._lock:
+            while limit is None or len(result) < limit:
+                self._pop_stale()
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                next_run, key = heapq.heappop(self._heap)
+                subscription = self._subscriptions[key]
+                # Следующий запуск - через интервал от запланированного, чтобы проверки не сбивались в кучу
+                following = next_run + subscription.interval
+                self._schedule(subscription, following if following > now else now + subscription.interval)
+                result.append((subscription.key, subscription.site, list(subscription.subscribers),
+                               list(subscription.fresh)))
+        return result
+
+    def overdue(self, now: float = None) -> int:
+        """Сколько поисков уже пора проверить"""
+        now = time.time() if now is None else now
+        with self._lock:
+            return sum(1 for subscription in self._subscriptions.values() if subscription.next_run <= now)
+
+    def next_delay(self, now: float = None) -> Optional[float]:
+        """Через сколько секунд следующий запуск (None - поисков нет)"""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._pop_stale()
+            if not self._heap:
+                return None
+            return max(0.0, self._heap[0][0] - now)
+
+    def changes(self) -> Tuple[Dict[str, Tuple[float, tuple]], List[str]]:
+        """Изменения расписания с прошлого вызова (для сохранения между перезапусками):
+        время следующего запуска и виденные объявления измененных поисков и ключи удаленных"""
+        with self._lock:
+            changed = {
+                key: (self._subscriptions[key].next_run, self._subscriptions[key].seen)
+                for key in self._changed
+            }
+            removed = list(self._removed)
+            self._changed.clear()
+            self._removed.clear()
+        return changed, removed
+
+    def stats(self) -> Dict[str, int]:
+        """Сколько уникальных поисков и подписок сейчас зарегистрировано"""
+        with self._lock:
+            return {
+                'searches': len(self._subscriptions),
+                'subscriptions': sum(len(s.subscribers) for s in self._subscriptions.values())
+            }
@@ -0,0 +1,55 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict
+
+class PoolFull(Exception):
+    """В пуле нет места для новой задачи"""
+
+class WorkerPool:
+    """Ограниченный пул потоков для загрузки и разбора страниц. Выполняется не больше
+    workers задач и ждет не больше queue_size; когда места нет, submit сообщает об этом
+    (PoolFull), а не копит задачи в бесконечной очереди."""
+
+    def __init__(self, workers: int = 8, queue_size: int = 32, name: str = 'worker'):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._pending = 0  # выполняются и ждут в очереди
+        self._rejected = 0
+
+    def free_slots(self) -> int:
+        """Сколько задач еще можно поставить"""
+        with self._lock:
+            return self.workers + self.queue_size - self._pending
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """Ставит задачу в пул и возвращает Future; PoolFull - если места нет"""
+        with self._lock:
+            if self._pending >= self.workers + self.queue_size:
+                self._rejected += 1
+                raise PoolFull(f"Пул занят: {self.workers} задач выполняется, {self.queue_size} в очереди")
+            self._pending += 1
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    def stats(self) -> Dict[str, int]:
+        """Занятость пула и сколько задач не поместилось"""
+        with self._lock:
+            return {
+                'running': min(self._pending, self.workers),
+                'queued': max(0, self._pending - self.workers),
+                'rejected': self._rejected
+            }
+
+    def close(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)